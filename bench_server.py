@@ -0,0 +1,356 @@
+# bench_server.py
+# load test / benchmark for pc_server.py.
+# starts pc_server.py on loopback for every combination of engine and metric backend, opens N simulated
+# display connections (1 to several thousand) that read at a realistic rate, and records per-message
+# inter-arrival jitter, staleness of the delivered values, server CPU, RSS and thread count.
+# results are written as JSON so runs can be compared between versions.
+#
+# python3 bench_server.py --clients 1,10,100,1000 --engines threads,asyncio --output bench.json
+#
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pc_server
+
+#AUTO-V
+version = "v0.1-2025/12/07r00"
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# main.py reads each message as it arrives on its asyncio stream
+DEFAULT_READ_INTERVAL = 0
+CONNECT_CONCURRENCY = 200  # connections opened at once, keeps the server backlog from overflowing
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def summary(values):
+    """min/p50/p95/p99/max of a list of numbers, rounded for the report"""
+    if not values:
+        return None
+    return {
+        'min': round(min(values), 2),
+        'p50': round(percentile(values, 50), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+        'max': round(max(values), 2),
+    }
+
+
+class ProcessMonitor:
+    """Samples CPU, RSS and thread count of a process from /proc once a second"""
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = []  # percent of one core
+        self.rss = []  # bytes
+        self.threads = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='monitor')
+        self._thread.daemon = True
+
+    def _read(self):
+        with open('/proc/{}/stat'.format(self.pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # fields after the command name: state is [0], utime [11], stime [12], num_threads [17], rss pages [21]
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        return cpu_ticks, int(fields[17]), int(fields[21]) * PAGE_SIZE
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def reset(self):
+        self.cpu, self.rss, self.threads = [], [], []
+
+    def _run(self):
+        try:
+            last_ticks, _, _ = self._read()
+            last_time = time.monotonic()
+            while not self._stop.wait(self.interval):
+                ticks, threads, rss = self._read()
+                now = time.monotonic()
+                self.cpu.append(100.0 * (ticks - last_ticks) / CLK_TCK / (now - last_time))
+                self.threads.append(threads)
+                self.rss.append(rss)
+                last_ticks, last_time = ticks, now
+        except (OSError, IndexError, ValueError):
+            pass  # process went away
+
+    def report(self):
+        return {
+            'cpu_percent': summary(self.cpu),
+            'rss_mb': summary([r / (1024.0 ** 2) for r in self.rss]),
+            'threads': summary(self.threads),
+        }
+
+
+class SubscriberStats:
+    """What one simulated display saw"""
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.staleness = []  # ms from server sample time to arrival
+        self.intervals = []  # ms between consecutive server timestamps
+        self.arrival_jitter = []  # ms, |arrival gap - server timestamp gap|
+        self.lost = 0  # sequence number gaps
+        self.connect_failed = False
+        self.disconnected = False
+
+
+def parse_frames(buffer, on_frame):
+    """Split complete binary frames off buffer, call on_frame(metric_id, seq, timestamp_ms), return the rest"""
+    header = pc_server.FRAME_STRUCT.size
+    entry = pc_server.BATCH_ENTRY_STRUCT.size
+    while len(buffer) >= header:
+        if buffer[0] != pc_server.FRAME_MAGIC:
+            pos = buffer.find(bytes([pc_server.FRAME_MAGIC]), 1)
+            buffer = buffer[pos:] if pos > 0 else b''
+            continue
+        magic, ver, metric_id, flags, seq, timestamp, raw = pc_server.FRAME_STRUCT.unpack_from(buffer)
+        size = header + (flags * entry if metric_id == pc_server.METRIC_BATCH else 0)
+        if len(buffer) < size:
+            break
+        buffer = buffer[size:]
+        on_frame(metric_id, seq, timestamp)
+    return buffer
+
+
+async def subscriber(host, port, protocol, read_interval, stats, stop, measuring, connect_limit):
+    """One simulated display connection"""
+    try:
+        async with connect_limit:
+            reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats.connect_failed = True
+        return
+    if protocol == 'binary':
+        writer.write(bytes([pc_server.HANDSHAKE_BASE | pc_server.PROTOCOL_VERSION]))
+    buffer = b''
+    state = {'seq': None, 'timestamp': None, 'arrival': None}
+
+    def on_frame(metric_id, seq, timestamp):
+        if metric_id == pc_server.METRIC_HELLO or not measuring.is_set():
+            state['seq'] = seq
+            return
+        now = time.time()
+        now_ms = int(now * 1000) & 0xFFFFFFFF
+        stats.messages += 1
+        stats.staleness.append(((now_ms - timestamp) & 0xFFFFFFFF) * 1.0)
+        if state['seq'] is not None:
+            stats.lost += max(0, ((seq - state['seq']) & 0xFFFFFFFF) - 1)
+        if state['timestamp'] is not None:
+            gap = ((timestamp - state['timestamp']) & 0xFFFFFFFF) * 1.0
+            stats.intervals.append(gap)
+            if read_interval == 0:
+                stats.arrival_jitter.append(abs((now - state['arrival']) * 1000.0 - gap))
+        state['seq'], state['timestamp'], state['arrival'] = seq, timestamp, now
+
+    try:
+        while not stop.is_set():
+            data = await reader.read(65536)
+            if not data:
+                stats.disconnected = True
+                break
+            if measuring.is_set():
+                stats.bytes += len(data)
+            if protocol == 'binary':
+                buffer = parse_frames(buffer + data, on_frame)
+            elif measuring.is_set():
+                stats.messages += data.count(b'\n')
+            if read_interval:
+                await asyncio.sleep(read_interval)
+    except OSError:
+        stats.disconnected = True
+    finally:
+        writer.close()
+
+
+async def run_clients(host, port, count, protocol, read_interval, warmup, duration):
+    stop = asyncio.Event()
+    measuring = asyncio.Event()
+    connect_limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    all_stats = [SubscriberStats() for _ in range(count)]
+    tasks = [asyncio.ensure_future(subscriber(host, port, protocol, read_interval, stats, stop, measuring, connect_limit))
+             for stats in all_stats]
+    await asyncio.sleep(warmup)
+    measuring.set()
+    started = time.monotonic()
+    await asyncio.sleep(duration)
+    elapsed = time.monotonic() - started
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return all_stats, elapsed
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(engine, backend, mode, port, extra_args):
+    cmd = [sys.executable, os.path.join(HERE, 'pc_server.py'), mode, '--host', '127.0.0.1', '--port', str(port),
+           '--engine', engine, '--backend', backend, '--backlog', '4096'] + extra_args
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("pc_server.py exited: {}".format(proc.stderr.read().decode().strip()))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("pc_server.py did not start listening")
+
+
+def run_case(engine, backend, clients, args):
+    """Benchmark one server configuration with one client count"""
+    port = free_port()
+    server = start_server(engine, backend, args.mode, port, args.server_args.split())
+    monitor = ProcessMonitor(server.pid)
+    monitor.start()
+    try:
+        all_stats, elapsed = asyncio.run(run_clients(
+            '127.0.0.1', port, clients, args.protocol, args.read_interval,
+            args.warmup, args.duration))
+    finally:
+        monitor.stop()
+        server.terminate()
+        server.wait()
+
+    messages = sum(s.messages for s in all_stats)
+    staleness, intervals, jitter = [], [], []
+    for s in all_stats:
+        staleness.extend(s.staleness)
+        intervals.extend(s.intervals)
+        jitter.extend(s.arrival_jitter)
+    interval_error = [abs(i - pc_server.TICK_INTERVAL * 1000) for i in intervals]
+    return {
+        'engine': engine,
+        'backend': backend,
+        'clients': clients,
+        'connected': sum(1 for s in all_stats if not s.connect_failed),
+        'disconnected': sum(1 for s in all_stats if s.disconnected),
+        'duration_s': round(elapsed, 2),
+        'messages': messages,
+        'messages_per_client_per_s': round(messages / float(clients) / elapsed, 3) if elapsed else 0,
+        'bytes': sum(s.bytes for s in all_stats),
+        'lost': sum(s.lost for s in all_stats),
+        'staleness_ms': summary(staleness),
+        'tick_interval_ms': summary(intervals),
+        'tick_interval_error_ms': summary(interval_error),
+        'arrival_jitter_ms': summary(jitter),
+        'server': monitor.report(),
+    }
+
+
+def print_case(result):
+    server = result['server']
+    staleness = result['staleness_ms'] or {}
+    interval = result['tick_interval_ms'] or {}
+    cpu = server['cpu_percent'] or {}
+    rss = server['rss_mb'] or {}
+    threads = server['threads'] or {}
+    print("{engine:>8} {backend:>7} {clients:>6} clients: {connected} connected, {rate} msg/s/client, "
+          "stale p50 {sp50}ms p95 {sp95}ms, tick p50 {tp50}ms p95 {tp95}ms, "
+          "cpu p50 {cpu}%, rss {rss}MB, threads {threads}".format(
+              engine=result['engine'], backend=result['backend'], clients=result['clients'],
+              connected=result['connected'], rate=result['messages_per_client_per_s'],
+              sp50=staleness.get('p50'), sp95=staleness.get('p95'),
+              tp50=interval.get('p50'), tp95=interval.get('p95'),
+              cpu=cpu.get('p50'), rss=rss.get('max'), threads=threads.get('max')))
+
+
+def int_list(text):
+    return [int(x) for x in text.split(',') if x.strip()]
+
+
+def name_list(text):
+    return [x.strip() for x in text.split(',') if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test pc_server.py with simulated displays")
+    parser.add_argument('--clients', type=int_list, default=[1, 10, 100, 1000],
+                        help="comma separated subscriber counts (default 1,10,100,1000)")
+    parser.add_argument('--engines', type=name_list, default=list(pc_server.ENGINES),
+                        help="server engines to compare (default {})".format(','.join(pc_server.ENGINES)))
+    parser.add_argument('--backends', type=name_list, default=['proc'],
+                        help="metric backends to compare (default proc)")
+    parser.add_argument('--mode', default='both', help="server mode (default both)")
+    parser.add_argument('--protocol', default='binary', choices=['binary', 'text'],
+                        help="binary frames carry timestamps, needed for staleness and jitter (default binary)")
+    parser.add_argument('--read-interval', type=float, default=DEFAULT_READ_INTERVAL,
+                        help="seconds each client waits between reads, 0 reads as data arrives (default {})".format(
+                            DEFAULT_READ_INTERVAL))
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds before measuring (default 2)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds measured per case (default 10)")
+    parser.add_argument('--server-args', default='', help="extra arguments passed to pc_server.py")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends:
+        for engine in args.engines:
+            for clients in args.clients:
+                try:
+                    result = run_case(engine, backend, clients, args)
+                except RuntimeError as e:
+                    print("{} {} {} clients: {}".format(engine, backend, clients, e))
+                    continue
+                print_case(result)
+                results.append(result)
+
+    report = {
+        'server_version': pc_server.version,
+        'bench_version': version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'settings': {
+            'mode': args.mode,
+            'protocol': args.protocol,
+            'read_interval': args.read_interval,
+            'warmup': args.warmup,
+            'duration': args.duration,
+            'server_args': args.server_args,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,22 +6,123 @@
 # still some flicker from the display. put the wifi ssid and password in wifi_settings.py and upload to your pico w.
 #
 # now handles context switching from the server, so 1 display can show both cpu and ram usage. with the cpu being suffixed with a C
+# networking runs as asyncio tasks that wake when data arrives, the display refresh keeps its own thread (core 1)
 import network
 import socket
 import time
 from machine import Pin, SPI
 import sys
-import select
+import struct
+import random
 import _thread
+try:
+    import asyncio  # MicroPython 1.21+, and CPython when run on a desktop
+except ImportError:
+    import uasyncio as asyncio
 from wifi_settings import WIFI_SSID, WIFI_PASSWORD
 
 #AUTO-V
 version = "v0.1-2025/12/07r12"
 
+# MicroPython tick functions, with CPython stand-ins so the display code can be run on a desktop
+if hasattr(time, 'ticks_us'):
+    ticks_ms = time.ticks_ms
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+    ticks_add = time.ticks_add
+    sleep_us = time.sleep_us
+else:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
+
+    def sleep_us(us):
+        time.sleep(us / 1000000)
+
 
 # PC server
 PC_IP = "192.168.1.201"
 PC_PORT = 9001
+# more servers to fail over to, as (ip, port), tried in order after PC_IP:PC_PORT
+PC_FALLBACKS = []
+
+# Reconnecting: the first retry is immediate, after that the wait doubles from RECONNECT_MIN_MS
+# up to RECONNECT_MAX_MS, with up to half of it taken off at random so displays don't all retry together
+RECONNECT_MIN_MS = 250
+RECONNECT_MAX_MS = 20000
+CONNECT_TIMEOUT_MS = 2000
+# no data for STALE_MS marks the value on screen as stale (dot on the last digit),
+# no data for DEAD_MS gives up on the connection. Longer than the 5s the server allows between messages
+# (MAX_SILENCE in pc_server.py caps its heartbeat and SUB rates).
+STALE_MS = 6000
+DEAD_MS = 15000
+
+# Wire protocol: 'text' lines like "45C" (works with any server), 'binary' frames, or 'segments' -
+# the server formats the value and sends the 4 finished display bytes, which are shown as they are
+PROTOCOL = 'text'
+
+# Ask the server for our own metrics and maximum rate instead of its default mode, e.g. "ram 1" (RAM at 1 Hz)
+# or "cpu 10", from 0.2 Hz up. '' keeps whatever the server was started with. Sent as "SUB <metrics> [<Hz>]" after connecting.
+SUBSCRIBE = ''
+
+# Latency tracing: the server tags every message with a sequence number and sample time, and once every
+# TRACE_ACK_MS this sends back "ACK <seq> <received->shown us> <received->ack us>" so the server can log
+# how old the numbers on the display are. Needs a server that knows TRACE, tcp only
+TRACE = False
+TRACE_ACK_MS = 1000
+
+# Transport: 'tcp' connects to the server(s) above, 'udp' listens for the frames a server started with
+# --udp publishes to UDP_GROUP:UDP_PORT (multicast group, or a broadcast/own address), always binary
+TRANSPORT = 'tcp'
+UDP_GROUP = "239.1.2.3"
+UDP_PORT = 9002
+
+# Binary protocol, must match pc_server.py
+PROTOCOL_VERSION = 2
+HANDSHAKE_BASE = 0xB0
+FRAME_MAGIC = 0xA5
+FRAME_FORMAT = '>BBBBIIi'  # magic, version, metric id, flags, seq, timestamp ms, value * 100
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+BATCH_ENTRY_FORMAT = '>Bi'  # metric id, value * 100
+BATCH_ENTRY_SIZE = struct.calcsize(BATCH_ENTRY_FORMAT)
+FIXED_POINT_SCALE = 100
+METRIC_HELLO = 0
+METRIC_BATCH = 255  # flags = number of entries following the header
+REORDER_WINDOW = 64  # a frame further behind than this means the sequence restarted
+# Server-rendered segments: magic, 4 segment bytes, check byte (xor of the bytes before it)
+# traced: SEGMENT_TRACE_MAGIC, 4 segment bytes, seq, sample time ms, check byte
+SEGMENT_HANDSHAKE = 0xC1
+SEGMENT_MAGIC = 0x5A
+SEGMENT_SIZE = 6
+SEGMENT_TRACE_MAGIC = 0x5B
+SEGMENT_TRACE_FORMAT = '>II'  # seq, sample time ms
+SEGMENT_TRACE_SIZE = SEGMENT_SIZE + struct.calcsize(SEGMENT_TRACE_FORMAT)
+
+# text lines end in CRLF, a line longer than this without one is thrown away (garbage, not a value)
+MAX_LINE = 32
+
+# when the server sends several metrics in one batch, show each for this long
+ROTATE_MS = 1000
+
+# Display refresh: full frames (all 4 digits) per second, and brightness as a duty cycle
+# BRIGHTNESS_LEVELS is full on, 0 is off. Each digit gets an equal slot of the frame.
+REFRESH_HZ = 500
+BRIGHTNESS_LEVELS = 8
+BRIGHTNESS = 8
+REFRESH_STATS_MS = 30000  # how often the refresh frame-time stats are printed
+# metric id -> display suffix: cpu, ram, swap, load1, load5, load15, net_rx, net_tx, disk_read, disk_write, temp
+METRIC_SUFFIX = {1: 'C', 2: '', 3: '', 4: '', 5: '', 6: '', 7: 'B', 8: 'B', 9: 'D', 10: 'D', 11: 'E'}
+for _i in range(64):
+    METRIC_SUFFIX[64 + _i] = 'C'  # core0..core63
+    METRIC_SUFFIX[128 + _i] = 'E'  # temp0..temp63
 
 # Pin definitions for 8-segment display
 MOSI = 11
@@ -53,7 +154,9 @@ SEG8Code = [
     0x5E, # D
     0x79, # E
     0x71, # F
+    0x40, # - (MINUS_DIGIT)
 ]
+MINUS_DIGIT = 16
 
 def safe_get_char(text, index):
     if index < len(text):
@@ -75,12 +178,19 @@ class LED_8SEG:
         self.spi = SPI(1, baudrate=1000000, polarity=0, phase=0, sck=Pin(SCK), mosi=Pin(MOSI))
         self.SEG8 = SEG8Code
         self.current_display = None
+        self.cmd = bytearray(2)  # reused for every write, no allocation in the refresh loop
 
-    def write_cmd(self, digit_addr, segment_data):
-        '''Write command to specific digit'''
+    def write_digit(self, digit_addr, segment_data):
+        '''Latch segment data onto one digit, timing is left to the caller'''
+        self.cmd[0] = digit_addr
+        self.cmd[1] = segment_data
         self.rclk.value(0)  # Latch low
-        self.spi.write(bytearray([digit_addr, segment_data]))
+        self.spi.write(self.cmd)
         self.rclk.value(1)  # Latch high
+
+    def write_cmd(self, digit_addr, segment_data):
+        '''Write command to specific digit'''
+        self.write_digit(digit_addr, segment_data)
         time.sleep(0.0002)
 
     def write_all(self, num_str):
@@ -155,18 +265,63 @@ def connect_wifi():
     print('IP address:', wlan.ifconfig()[0])
     return wlan
 
-def connect_to_pc():
-    """Connect to PC server"""
-    try:
-        # Create socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5.0)  # 5 second timeout
+class Reconnector:
+    """Reconnect state machine: which server to try next and how long to wait first.
+    Servers are tried in order, the backoff applies between passes over the whole list
+    and a lost connection starts again from the preferred one.
+    """
+    def __init__(self, servers, min_ms=RECONNECT_MIN_MS, max_ms=RECONNECT_MAX_MS):
+        self.servers = servers
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.index = 0
+        self.failures = 0  # failed attempts since the last connection
+
+    def server(self):
+        """(ip, port) to try next"""
+        return self.servers[self.index]
+
+    def delay_ms(self):
+        """How long to wait before the next attempt"""
+        if self.failures % len(self.servers):
+            return 0  # still working through the list
+        rounds = self.failures // len(self.servers)
+        if rounds <= 1:
+            return 0  # first attempt and the first retry of the whole list go straight away
+        delay = min(self.max_ms, self.min_ms << min(rounds - 2, 16))
+        return delay - ((delay * random.getrandbits(8)) >> 9)  # jitter: take off up to half
+
+    def failed(self):
+        """Connecting failed, or the server hung up before sending anything"""
+        self.failures += 1
+        self.index = (self.index + 1) % len(self.servers)
 
+    def lost(self):
+        """A working connection went away"""
+        self.index = 0
+        self.failures = 0
+
+async def connect_to_pc(ip=None, port=None):
+    """Connect to PC server, returns the (reader, writer) streams or None"""
+    ip = ip or PC_IP
+    port = port or PC_PORT
+    try:
         # Connect to PC server
-        print('Connecting to PC server at {}:{}'.format(PC_IP, PC_PORT))
-        sock.connect((PC_IP, PC_PORT))
+        print('Connecting to PC server at {}:{}'.format(ip, port))
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), CONNECT_TIMEOUT_MS / 1000)
         print('Connected to PC server')
-        return sock
+        if PROTOCOL == 'binary':
+            # ask for binary frames, servers that don't know it keep sending text (Receiver falls back to it)
+            writer.write(bytes([HANDSHAKE_BASE | PROTOCOL_VERSION]))
+        elif PROTOCOL == 'segments':
+            # needs a server that knows it, text from an older one is skipped as garbage
+            writer.write(bytes([SEGMENT_HANDSHAKE]))
+        if SUBSCRIBE:
+            writer.write('SUB {}\n'.format(SUBSCRIBE).encode())
+        if TRACE:
+            writer.write(b'TRACE\n')
+        await writer.drain()
+        return reader, writer
     except Exception as e:
         print('Failed to connect to PC server:', e)
         return None
@@ -189,9 +344,22 @@ def format_value_with_decimal_and_suffix(value, suffix=''):
     Returns tuple: (digit0, digit1, digit2, digit3, dot_position)
     dot_position: 0-3 for which digit gets the dot, or -1 for no dot
     suffix: letter to replace last digit (e.g., 'C' for CPU or 'R' for RAM)
+    Negative values (a server rate filter on a falling gauge) get MINUS_DIGIT first: -XX.X, -XXX or -XX<suffix>
     """
     try:
         val = float(value)
+
+        if val < 0:
+            val = -val
+            if suffix and suffix.upper() in '0123456789ABCDEF':
+                formatted = int(val) % 100
+                suffix_val = ord(suffix.upper()) - ord('0') if suffix.isdigit() else ord(suffix.upper()) - ord('A') + 10
+                return (MINUS_DIGIT, formatted // 10, formatted % 10, suffix_val, -1)
+            if val >= 100:
+                formatted = int(val) % 1000
+                return (MINUS_DIGIT, formatted // 100, (formatted % 100) // 10, formatted % 10, -1)
+            formatted = int(val * 10) % 1000
+            return (MINUS_DIGIT, formatted // 100, (formatted % 100) // 10, formatted % 10, 2)
         
         # Handle suffix - replace the last digit position with the suffix letter
         if suffix and suffix.upper() in '0123456789ABCDEF':
@@ -240,48 +408,662 @@ def format_value_with_decimal_and_suffix(value, suffix=''):
     except:
         return (0, 0, 0, 0, -1)
 
-# Shared variable for CPU usage and optional suffix
-cpu_usage = None
-display_suffix = ''
+# Digit addresses in display order, used by the refresh loop
+DIGIT_ADDRS = (KILOBIT, HUNDREDS, TENS, UNITS)
+
+def render_segments(value, suffix, out):
+    """Render a value into 4 ready-to-write segment bytes in out (dots and suffix applied)"""
+    digit0, digit1, digit2, digit3, dot_pos = format_value_with_decimal_and_suffix(value, suffix)
+    out[0] = SEG8Code[digit0]
+    out[1] = SEG8Code[digit1]
+    out[2] = SEG8Code[digit2]
+    out[3] = SEG8Code[digit3]
+    # Apply dot to appropriate digit
+    if 0 <= dot_pos <= 3:
+        out[dot_pos] |= Dot
+
+class FrameBuffer:
+    """Triple buffered segment frame shared between the network side and the refresh thread.
+    publish() renders a new value once into a back buffer and then makes it the front one, so the
+    refresh loop only ever sees a complete frame and never formats anything. publish_segments() does
+    the same with bytes the server already rendered. The third buffer means a back buffer is never
+    the one the refresh thread is still showing, however quickly frames are published.
+    """
+    def __init__(self):
+        self.buffers = (bytearray(4), bytearray(4), bytearray(4))
+        self.front = None  # index of the newest frame, None until the first value
+        self.reading = None  # index of the frame the refresh thread is showing
+        self.lock = _thread.allocate_lock()  # guards front/reading, never held while rendering
+        self.value = None
+        self.suffix = ''
+        self.segments = None  # last server-rendered frame
+        self.stale = False
+        self.generation = 0  # counts frame swaps
+        self.shown_generation = -1  # newest frame the refresh thread has started showing
+        self.watching = None  # generation the latency probe waits to see shown
+        self.shown_us = None  # ticks_us when it was
+
+    def publish(self, value, suffix=''):
+        """Render value into the back buffer and make it the front one"""
+        if value == self.value and suffix == self.suffix:
+            return  # same frame as already shown
+        back = self._back()
+        render_segments(value, suffix, self.buffers[back])
+        if self.stale:
+            self.buffers[back][3] |= Dot
+        self.value = value
+        self.suffix = suffix
+        self.segments = None
+        self._swap(back)
+
+    def publish_segments(self, segments):
+        """Copy 4 server-rendered segment bytes into the back buffer and make it the front one"""
+        if segments == self.segments:
+            return
+        back = self._back()
+        self.buffers[back][:] = segments
+        if self.stale:
+            self.buffers[back][3] |= Dot
+        self.segments = segments
+        self.value = None
+        self._swap(back)
+
+    def set_stale(self, stale):
+        """Keep the value on screen but mark it with a dot on the last digit, which values never use"""
+        if stale == self.stale:
+            return
+        self.stale = stale
+        if self.front is not None:
+            back = self._back()
+            self.buffers[back][:] = self.buffers[self.front]
+            if stale:
+                self.buffers[back][3] |= Dot
+            else:
+                self.buffers[back][3] &= 0x7F
+            self._swap(back)
+
+    def _back(self):
+        """A buffer that is neither the front one nor the one the refresh thread is showing"""
+        with self.lock:
+            for index in (0, 1, 2):
+                if index != self.front and index != self.reading:
+                    return index
+
+    def _swap(self, back):
+        with self.lock:
+            self.front = back
+            self.generation += 1
+
+    def watch(self, generation):
+        """Time when the refresh thread first shows this frame (or a newer one) in shown_us"""
+        self.shown_us = None
+        self.watching = generation
+        if self.shown_generation >= generation:
+            # already on the display, e.g. an unchanged value
+            self.watching = None
+            self.shown_us = ticks_us()
+
+    def mark_shown(self, generation):
+        """Called by the refresh thread when it starts showing a new frame"""
+        self.shown_generation = generation
+        watching = self.watching
+        if watching is not None and generation >= watching:
+            self.shown_us = ticks_us()
+            self.watching = None
+
+    def take(self):
+        """For the refresh thread: (frame to show, its generation), frame is None before the first value.
+        The frame is left alone until the next take()
+        """
+        with self.lock:
+            front = self.front
+            self.reading = front
+            generation = self.generation
+        if front is None:
+            return None, generation
+        return self.buffers[front], generation
+
+# Shared frame for the display thread
+frame_buffer = FrameBuffer()
+
+class RefreshScheduler:
+    """Multiplexes a 4 digit frame on a microsecond deadline schedule.
+    Every digit gets the same slot of the frame period whatever else is going on, so refresh rate
+    and brightness stay even. Brightness below full blanks the digit for the rest of its slot.
+    A frame or slot that starts late (a GC pause or IRQ overran the one before) gets its slots from now
+    instead of squeezing them to catch up, which would starve some digits. Frames more than a whole
+    period late also count as overruns.
+    """
+    def __init__(self, refresh_hz=REFRESH_HZ, brightness=BRIGHTNESS, clock=None, sleeper=None):
+        self.clock = clock or ticks_us
+        self.sleeper = sleeper or sleep_us
+        self.set_rate(refresh_hz)
+        self.set_brightness(brightness)
+        self.next_frame = None
+        self.reset_stats()
+
+    def set_rate(self, refresh_hz):
+        self.period_us = 1000000 // refresh_hz
+        self.slot_us = self.period_us // 4
+
+    def set_brightness(self, level):
+        """Software brightness, 0 (off) to BRIGHTNESS_LEVELS (full)"""
+        self.brightness = max(0, min(BRIGHTNESS_LEVELS, level))
+        self.on_us = self.slot_us * self.brightness // BRIGHTNESS_LEVELS
+
+    def reset_stats(self):
+        self.frames = 0
+        self.overruns = 0
+        self.late = 0  # frames or slots that started after their deadline
+        self.late_max = 0
+        self.frame_min = None
+        self.frame_max = 0
+        self.frame_total = 0
+        self.last_start = None
+
+    def stats(self):
+        """Frame time statistics since the last reset, times in microseconds"""
+        measured = self.frames - 1 if self.frames > 1 else 0
+        average = self.frame_total // measured if measured else 0
+        return {
+            'frames': self.frames,
+            'overruns': self.overruns,
+            'late': self.late,
+            'late_max_us': self.late_max,
+            'target_us': self.period_us,
+            'min_us': self.frame_min or 0,
+            'max_us': self.frame_max,
+            'avg_us': average,
+            'fps': 1000000 // average if average else 0,
+            'brightness': self.brightness,
+        }
+
+    def wait_until(self, deadline):
+        remaining = ticks_diff(deadline, self.clock())
+        if remaining > 0:
+            self.sleeper(remaining)
+
+    def count_late(self, lateness):
+        self.late += 1
+        self.late_max = max(self.late_max, lateness)
+        if lateness > self.period_us:
+            self.overruns += 1
+
+    def run_frame(self, display, frame):
+        """Show one full frame (4 segment bytes) on its schedule"""
+        now = self.clock()
+        lateness = 0 if self.next_frame is None else ticks_diff(now, self.next_frame)
+        if self.next_frame is None or lateness > 0:
+            if lateness > 0:
+                self.count_late(lateness)
+            self.next_frame = now
+        else:
+            self.wait_until(self.next_frame)
+        start = self.next_frame
+
+        # measured frame time, start to start
+        if self.last_start is not None:
+            frame_time = ticks_diff(self.clock(), self.last_start)
+            if self.frame_min is None or frame_time < self.frame_min:
+                self.frame_min = frame_time
+            if frame_time > self.frame_max:
+                self.frame_max = frame_time
+            self.frame_total += frame_time
+        self.last_start = self.clock()
+        self.frames += 1
+
+        for i in range(4):
+            slot_start = ticks_add(start, i * self.slot_us)
+            lateness = ticks_diff(self.clock(), slot_start) if i else 0
+            if lateness > 0:
+                # the previous slot overran, this digit and the ones after it get full slots from now
+                self.count_late(lateness)
+                start = ticks_add(start, lateness)
+                slot_start = ticks_add(slot_start, lateness)
+            else:
+                self.wait_until(slot_start)
+            if self.on_us > 0:
+                display.write_digit(DIGIT_ADDRS[i], frame[i])
+            if self.on_us < self.slot_us:
+                self.wait_until(ticks_add(slot_start, self.on_us))
+                display.write_digit(DIGIT_ADDRS[i], 0x00)
+        self.next_frame = ticks_add(start, self.period_us)
+
+# Shared refresh schedule, stats() can be queried from the network side
+refresh = RefreshScheduler()
+
+class FrameDecoder:
+    """Collects received bytes and unpacks complete binary frames,
+    uses the sequence numbers to count lost or out of order updates
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.last_seq = None
+        self.lost = 0
+        self.reordered = 0
+
+    def reset(self):
+        """Call after reconnecting, sequence numbers restart per connection"""
+        self.buffer = b''
+        self.last_seq = None
+
+    def feed_datagram(self, data):
+        """Like feed(), for a datagram - which holds whole frames, a truncated one is not continued"""
+        self.buffer = b''
+        return self.feed(data)
+
+    def feed(self, data):
+        """Add received bytes, return a list of (metric_id, value, seq, timestamp_ms)
+        a batch frame comes back as (METRIC_BATCH, [(metric_id, value), ...], seq, timestamp_ms)
+        """
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_SIZE:
+            if self.buffer[0] != FRAME_MAGIC:
+                # out of step (or text from an old server), resync on the next magic byte
+                pos = self.buffer.find(bytes([FRAME_MAGIC]), 1)
+                self.buffer = self.buffer[pos:] if pos > 0 else b''
+                continue
+            magic, version, metric_id, flags, seq, timestamp, raw = struct.unpack(FRAME_FORMAT, self.buffer[:FRAME_SIZE])
+            if metric_id == METRIC_BATCH:
+                size = FRAME_SIZE + flags * BATCH_ENTRY_SIZE
+                if len(self.buffer) < size:
+                    break  # wait for the rest of the batch
+                entries = []
+                for pos in range(FRAME_SIZE, size, BATCH_ENTRY_SIZE):
+                    entry_id, entry_raw = struct.unpack(BATCH_ENTRY_FORMAT, self.buffer[pos:pos + BATCH_ENTRY_SIZE])
+                    entries.append((entry_id, entry_raw / FIXED_POINT_SCALE))
+                value = entries
+            else:
+                size = FRAME_SIZE
+                value = raw / FIXED_POINT_SCALE
+            self.buffer = self.buffer[size:]
+            if self.last_seq is not None:
+                gap = (seq - self.last_seq) & 0xFFFFFFFF
+                if gap == 0 or gap > 0x7FFFFFFF:
+                    if ((self.last_seq - seq) & 0xFFFFFFFF) <= REORDER_WINDOW:
+                        self.reordered += 1
+                        continue  # older than what is already shown
+                    gap = 1  # far behind: the server restarted (udp has no reconnect to reset on)
+                self.lost += gap - 1
+            self.last_seq = seq
+            frames.append((metric_id, value, seq, timestamp))
+        return frames
+
+class LineReader:
+    """Collects received bytes and splits them into lines, a partial line is kept
+    until the rest arrives. Only the newest complete line matters for the display,
+    so any backlog is skipped rather than shown one stale value after another
+    """
+    def __init__(self, max_line=MAX_LINE):
+        self.buffer = b''
+        self.max_line = max_line
+        self.skipped = 0  # complete lines replaced by a newer one before being shown
+
+    def reset(self):
+        """Call after reconnecting, a partial line from the old connection is useless"""
+        self.buffer = b''
+
+    def feed(self, data):
+        """Add received bytes, return the list of complete lines (without the line ending)"""
+        self.buffer += data
+        end = self.buffer.rfind(b'\n')
+        if end < 0:
+            if len(self.buffer) > self.max_line:
+                self.buffer = b''
+            return []
+        lines = self.buffer[:end].split(b'\n')
+        self.buffer = self.buffer[end + 1:]
+        return [line.strip() for line in lines if line.strip()]
+
+    def latest(self, data):
+        """Add received bytes, return the newest complete line or None"""
+        lines = self.feed(data)
+        if not lines:
+            return None
+        self.skipped += len(lines) - 1
+        return lines[-1]
+
+class SegmentReader:
+    """Collects received bytes and picks out server-rendered segment frames, resyncing on the
+    magic byte when the check byte doesn't match. Only the newest frame is returned for the display
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.skipped = 0  # complete frames replaced by a newer one before being shown
+        self.seq = None  # sequence number of the newest frame, traced frames only
+
+    def reset(self):
+        """Call after reconnecting"""
+        self.buffer = b''
+
+    def latest(self, data):
+        """Add received bytes, return the newest 4 segment bytes or None"""
+        self.buffer += data
+        segments = None
+        while len(self.buffer) >= SEGMENT_SIZE:
+            magic = self.buffer[0]
+            size = SEGMENT_TRACE_SIZE if magic == SEGMENT_TRACE_MAGIC else SEGMENT_SIZE
+            if magic == SEGMENT_TRACE_MAGIC and len(self.buffer) < size:
+                break  # wait for the rest
+            check = 0
+            for byte in self.buffer[:size - 1]:
+                check ^= byte
+            if magic not in (SEGMENT_MAGIC, SEGMENT_TRACE_MAGIC) or self.buffer[size - 1] != check:
+                # out of step (or a text reply), resync on the next magic byte
+                pos = [p for p in (self.buffer.find(bytes([SEGMENT_MAGIC]), 1),
+                                   self.buffer.find(bytes([SEGMENT_TRACE_MAGIC]), 1)) if p > 0]
+                self.buffer = self.buffer[min(pos):] if pos else b''
+                continue
+            if segments is not None:
+                self.skipped += 1
+            segments = self.buffer[1:5]
+            self.seq = struct.unpack(SEGMENT_TRACE_FORMAT, self.buffer[5:size - 1])[0] if size > SEGMENT_SIZE else None
+            self.buffer = self.buffer[size:]
+        return segments
+
+class LatencyProbe:
+    """Times one traced message every TRACE_ACK_MS from arriving to the refresh thread showing it,
+    and builds the ACK the server turns into its latency stats
+    """
+    def __init__(self):
+        self.seq = None
+        self.received_us = 0
+        self.next_ms = ticks_ms()
+
+    def reset(self):
+        self.seq = None
+
+    def received(self, seq, received_us):
+        """Call after a traced message has been applied to the frame buffer"""
+        if self.seq is not None or ticks_diff(ticks_ms(), self.next_ms) < 0:
+            return
+        self.seq = seq
+        self.received_us = received_us
+        frame_buffer.watch(frame_buffer.generation)
+
+    def ack(self):
+        """The ACK line once the display has shown the timed message, else None"""
+        shown_us = frame_buffer.shown_us
+        if self.seq is None or shown_us is None:
+            return None
+        line = "ACK {} {} {}\n".format(self.seq, max(0, ticks_diff(shown_us, self.received_us)),
+                                      ticks_diff(ticks_us(), self.received_us))
+        self.seq = None
+        self.next_ms = ticks_add(ticks_ms(), TRACE_ACK_MS)
+        return line.encode()
+
+def parse_text_value(line):
+    """Split a text line like b"45C" into (45.0, 'C'), raises ValueError if it isn't a value"""
+    value_str = line.decode('utf-8')
+    suffix = ''
+    # Check if last character is a letter (suffix)
+    if value_str and value_str[-1].isalpha():
+        suffix = value_str[-1].upper()
+        value_str = value_str[:-1]
+    return float(value_str), suffix
+
+class MetricRotation:
+    """Keeps the newest value of every metric from batch frames and rotates the
+    display through them locally, so the value shown after a switch is always current
+    """
+    def __init__(self, period_ms=ROTATE_MS):
+        self.period_ms = period_ms
+        self.values = {}  # metric id -> newest value
+        self.order = []  # metric ids in the order the server lists them
+        self.index = 0
+        self.switched_at = ticks_ms()
+
+    def reset(self):
+        self.values = {}
+        self.order = []
+        self.index = 0
+
+    def update(self, entries):
+        """Store the values from one batch frame"""
+        order = []
+        for metric_id, value in entries:
+            self.values[metric_id] = value
+            order.append(metric_id)
+        if order != self.order:
+            self.order = order
+            self.index = 0
+
+    def next_switch_ms(self):
+        """Milliseconds until current() moves on to the next metric"""
+        if len(self.order) < 2:
+            return self.period_ms
+        return max(0, self.period_ms - ticks_diff(ticks_ms(), self.switched_at))
+
+    def current(self):
+        """Return (value, suffix) to show now, or None before the first batch"""
+        if not self.order:
+            return None
+        now = ticks_ms()
+        if ticks_diff(now, self.switched_at) >= self.period_ms:
+            self.index = (self.index + 1) % len(self.order)
+            self.switched_at = now
+        metric_id = self.order[self.index % len(self.order)]
+        return self.values[metric_id], METRIC_SUFFIX.get(metric_id, '')
 
 def display_updater():
     """Function to continuously update the display"""
-    global display_suffix
     display = LED_8SEG()
     display.clear_display()
+    shown = 0
 
     while True:
-        if cpu_usage is not None:
+        frame, generation = frame_buffer.take()
+        if frame is not None:
+            if generation != shown:
+                shown = generation
+                frame_buffer.mark_shown(generation)  # for the latency probe
             try:
-                digit0, digit1, digit2, digit3, dot_pos = format_value_with_decimal_and_suffix(cpu_usage, display_suffix)
-                
-                # Write each digit with optional dot
-                seg0 = display.SEG8[digit0]
-                seg1 = display.SEG8[digit1]
-                seg2 = display.SEG8[digit2]
-                seg3 = display.SEG8[digit3]
-                
-                # Apply dot to appropriate digit
-                if dot_pos == 1:
-                    seg1 |= Dot
-                elif dot_pos == 2:
-                    seg2 |= Dot
-                elif dot_pos == 3:
-                    seg3 |= Dot
-                
-                # Write to display
-                display.write_cmd(KILOBIT, seg0)
-                display.write_cmd(HUNDREDS, seg1)
-                display.write_cmd(TENS, seg2)
-                display.write_cmd(UNITS, seg3)
+                # Only push the cached segment bytes, formatting was done when the value arrived
+                refresh.run_frame(display, frame)
             except Exception as e:
                 debug_output("Error updating display: {}".format(e))
-        #time.sleep(0.1)  # Update every 100ms
+        else:
+            sleep_us(refresh.period_us)
 
-def main():
-    global cpu_usage
-    global display_suffix
+async def sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
 
+class Receiver:
+    """Turns received bytes into display updates, for either wire protocol"""
+    def __init__(self, protocol=None):
+        self.protocol = protocol or PROTOCOL
+        self.mode = self.protocol  # what this connection really speaks, see handle()
+        self.fresh = True  # nothing received on this connection yet
+        self.decoder = FrameDecoder()
+        self.lines = LineReader()
+        self.segments = SegmentReader()
+        self.rotation = MetricRotation()
+        self.probe = LatencyProbe()
+
+    def reset(self):
+        """Call after reconnecting"""
+        self.mode = self.protocol
+        self.fresh = True
+        self.decoder.reset()
+        self.lines.reset()
+        self.segments.reset()
+        self.rotation.reset()
+        self.probe.reset()
+
+    def handle(self, data, datagram=False):
+        received_us = ticks_us()
+        frame_buffer.set_stale(False)
+        if self.fresh and self.mode == 'binary' and not datagram and data[:1] != bytes([FRAME_MAGIC]):
+            # a binary server answers the handshake with a hello frame first, an old one
+            # ignores it and sends text lines, which the frame decoder would throw away
+            print("Server doesn't speak the binary protocol, using text")
+            self.mode = 'text'
+        self.fresh = False
+        if self.mode == 'binary':
+            frames = self.decoder.feed_datagram(data) if datagram else self.decoder.feed(data)
+            last_seq = None
+            for metric_id, value, seq, timestamp in frames:
+                if metric_id == METRIC_HELLO:
+                    debug_output("Server speaks binary protocol v{}".format(int(value)))
+                elif metric_id == METRIC_BATCH:
+                    self.rotation.update(value)
+                    last_seq = seq
+                elif metric_id in METRIC_SUFFIX:
+                    self.rotation.reset()
+                    frame_buffer.publish(value, METRIC_SUFFIX[metric_id])
+                    last_seq = seq
+            if self.decoder.lost or self.decoder.reordered:
+                debug_output("Frames lost: {} reordered: {}".format(self.decoder.lost, self.decoder.reordered))
+            # a batch updates the rotation, show its newest value straight away
+            shown = self.rotation.current()
+            if shown is not None:
+                frame_buffer.publish(shown[0], shown[1])
+            if TRACE and last_seq is not None:
+                self.probe.received(last_seq, received_us)
+            return
+
+        if self.mode == 'segments':
+            # already formatted by the server, straight into the display buffer
+            segments = self.segments.latest(data)
+            if segments is not None:
+                frame_buffer.publish_segments(segments)
+                if self.segments.seq is not None:
+                    self.probe.received(self.segments.seq, received_us)
+            return
+
+        # one recv can hold several lines and/or part of one, only the newest value is shown
+        line = self.lines.latest(data)
+        if line is not None and line[:1].isalpha():
+            # reply to a command, e.g. "SUB ram 1" or "ERR ...", values always start with a digit
+            debug_output("Server: {}".format(line.decode('utf-8')))
+        elif line is not None:
+            try:
+                # Parse data - may contain suffix like 'C' for CPU, traced lines add "<seq> <sample ms>"
+                fields = line.split()
+                value, suffix = parse_text_value(fields[0])
+                frame_buffer.publish(value, suffix)
+                if len(fields) == 3:
+                    self.probe.received(int(fields[1]), received_us)
+                debug_output("Received data: {}{}".format(value, suffix))
+            except ValueError:
+                print("Invalid data received:", line)
+
+async def network_task(receiver, reconnector):
+    """Connect, then apply data the moment it arrives - fails over and backs off when servers go away"""
+    while True:
+        delay = reconnector.delay_ms()
+        if delay:
+            print("Retrying in {}ms...".format(delay))
+            await sleep_ms(delay)
+        ip, port = reconnector.server()
+        streams = await connect_to_pc(ip, port)
+        if streams is None:
+            reconnector.failed()
+            continue
+        reader, writer = streams
+        print("Connected to PC server, ready to receive CPU data...")
+        receiver.reset()
+        last_data = ticks_ms()
+        got_data = False
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(1024), STALE_MS / 1000)
+                except asyncio.TimeoutError:
+                    frame_buffer.set_stale(True)
+                    if ticks_diff(ticks_ms(), last_data) >= DEAD_MS:
+                        print("No data for {}s, dropping the connection".format(DEAD_MS // 1000))
+                        break
+                    continue
+                if not data:
+                    # Empty data means server closed the connection
+                    print("Server closed connection")
+                    break
+                last_data = ticks_ms()
+                got_data = True
+                # the previous timed message has been on the display for a while by now
+                ack = receiver.probe.ack()
+                if ack:
+                    writer.write(ack)
+                    await writer.drain()
+                receiver.handle(data)
+        except Exception as e:
+            print("Error receiving data:", e)
+        finally:
+            writer.close()
+        # keep the last value on screen, marked stale until data flows again
+        frame_buffer.set_stale(True)
+        if got_data:
+            reconnector.lost()
+        else:
+            reconnector.failed()  # accepted then closed, don't hammer it
+        print("Attempting to reconnect to PC server...")
+
+async def rotation_task(receiver):
+    """Switch between batched metrics on our own schedule, only waking when a switch is due"""
+    while True:
+        await sleep_ms(receiver.rotation.next_switch_ms())
+        shown = receiver.rotation.current()
+        if shown is not None:
+            frame_buffer.publish(shown[0], shown[1])
+
+async def stats_task():
+    while True:
+        await sleep_ms(REFRESH_STATS_MS)
+        debug_output("Refresh: {}".format(refresh.stats()))
+        refresh.reset_stats()
+
+class DatagramReader:
+    """Awaitable recv() for a UDP socket: CPython's loop.sock_recv, or MicroPython's stream wrapper
+    (which waits for the socket to be readable and then reads one datagram)
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        loop = asyncio.get_event_loop()
+        self.loop = loop if hasattr(loop, 'sock_recv') else None
+        self.stream = None if self.loop else asyncio.StreamReader(sock)
+
+    async def recv(self, size):
+        if self.loop:
+            return await self.loop.sock_recv(self.sock, size)
+        return await self.stream.read(size)
+
+def open_udp(group, port):
+    """Bind the UDP port, joining group if it is a multicast address"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    octets = bytes(int(part) for part in group.split('.'))
+    if 224 <= octets[0] <= 239:
+        # ip_mreq: group address, then local interface (any)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, octets + bytes(4))
+    sock.setblocking(False)
+    return sock
+
+async def udp_task(receiver):
+    """Show frames published by a server started with --udp, no connection to keep up"""
+    sock = open_udp(UDP_GROUP, UDP_PORT)
+    print("Listening for udp://{}:{}".format(UDP_GROUP, UDP_PORT))
+    datagrams = DatagramReader(sock)
+    while True:
+        try:
+            data = await asyncio.wait_for(datagrams.recv(1024), STALE_MS / 1000)
+        except asyncio.TimeoutError:
+            frame_buffer.set_stale(True)
+            continue
+        receiver.handle(data, datagram=True)
+
+async def run_client():
+    if TRANSPORT == 'udp':
+        receiver = Receiver('binary')
+        net_task = udp_task(receiver)
+    else:
+        receiver = Receiver()
+        net_task = network_task(receiver, Reconnector([(PC_IP, PC_PORT)] + PC_FALLBACKS))
+    await asyncio.gather(net_task, rotation_task(receiver), stats_task())
+
+def main():
     # Initialize display (for test loop)
     display = LED_8SEG()
     display.clear_display()
@@ -296,87 +1078,14 @@ def main():
     # Connect to WiFi
     connect_wifi()
 
-    # Connect to PC server - retry forever every 20 seconds
-    sock = None
-    while True:
-        sock = connect_to_pc()
-        if sock is not None:
-            break
-        print("Failed to connect to PC server, retrying in 20 seconds...")
-        time.sleep(20)
-
-    print("Connected to PC server, ready to receive CPU data...")
-
     try:
-        while True:
-            try:
-                # Use select to check if there's data available
-                readable, _, _ = select.select([sock], [], [], 0.1)  # Timeout of 0.1 seconds
-
-                if sock in readable:
-                    # Receive data from PC
-                    data = sock.recv(1024).decode('utf-8').strip()
-                    if data:
-                        try:
-                            # Parse data - may contain suffix like 'C' for CPU
-                            value_str = data
-                            suffix = ''
-                            
-                            # Check if last character is a letter (suffix)
-                            if value_str and value_str[-1].isalpha():
-                                suffix = value_str[-1].upper()
-                                value_str = value_str[:-1]
-                            
-                            # Convert to float and update shared variables
-                            cpu_usage = float(value_str)
-                            display_suffix = suffix
-                            debug_output("Received data: {}{}".format(cpu_usage, suffix))
-                        except ValueError:
-                            print("Invalid data received:", data)
-                    else:
-                        # Empty data means server closed the connection
-                        print("Server closed connection")
-                        print("Attempting to reconnect to PC server...")
-                        sock = connect_to_pc()
-                        while sock is None:
-                            print("Failed to reconnect to PC server, retrying in 20 seconds...")
-                            time.sleep(20)
-                            sock = connect_to_pc()
-                        print("Reconnected to PC server")
-
-                # Small delay to prevent excessive CPU usage
-                time.sleep(0.2)
-
-            except socket.error as e:
-                print("Socket error:", e)
-                print("Attempting to reconnect to PC server...")
-                sock = connect_to_pc()
-                while sock is None:
-                    print("Failed to reconnect to PC server, retrying in 20 seconds...")
-                    time.sleep(20)
-                    sock = connect_to_pc()
-                print("Reconnected to PC server")
-
-            except Exception as e:
-                print("Error receiving data:", e)
-                # Attempt to reconnect
-                sock = connect_to_pc()
-                while sock is None:
-                    print("Failed to reconnect to PC server, retrying in 20 seconds...")
-                    time.sleep(20)
-                    sock = connect_to_pc()
-                print("Reconnected to PC server")
-
+        asyncio.run(run_client())
     except KeyboardInterrupt:
         print("Stopping...")
         display.clear_display()
-        if sock is not None:
-            sock.close()
     except Exception as e:
         print("Unexpected error:", e)
         display.clear_display()
-        if sock is not None:
-            sock.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -2,163 +2,2395 @@
 # this is the server part that runs on a linux pc and serves cpu or ram stats to the the pico w client.
 # by default it outputs cpu %, add 'ram' to the command line to output ram usage.
 # updated so 'both' on the cmd line switches context every second.
+# clients can switch to compact binary frames by sending a handshake byte, text lines stay the default.
+# or to server-rendered segments: 6 byte messages holding the 4 finished display bytes, so no formatting on the pico.
+# --filter smooths noisy metrics once per sample on the server, e.g. cpu=median:5+ema:0.3
+# a client can pick its own metrics and rate by sending "SUB ram 1" (RAM at 1 Hz), otherwise it gets the mode above.
+# a client can send "TRACE" to have its messages tagged and acked, the server then logs its latency per stage.
+# keeps a fixed size history of every sampled metric, clients can ask for e.g. "HIST cpu max 5m".
+# several hosts: 'pc_server.py cpu,ram --agent AGGREGATOR' pushes this host's values to an aggregator
+# started with --aggregate-port, whose displays show e.g. cpu@web1 (one host) or cpu@max (across all hosts).
+# --udp also publishes every snapshot once to a multicast group or broadcast address, for any number of displays.
 #
 import socket
+import struct
 import time
-import subprocess
+import argparse
+import array
+import bisect
+import os
+import select
+import glob
+import math
+import logging
+import logging.handlers
+import asyncio
 import threading
 import sys
+from collections import namedtuple, deque
+from queue import Queue, Full
+from types import MappingProxyType
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 #AUTO-V
 version = "v0.1-2025/12/07r13"
 
 
+# Server configuration
+HOST = '192.168.1.201'  # Listen on all interfaces
+PORT = 9001
+LISTEN_BACKLOG = 128  # pending connections queued by the kernel
 
+# per-client sending
+SEND_QUEUE_SIZE = 1  # messages waiting per client, oldest is dropped when full (latest value wins)
+SEND_DEADLINE = 10.0  # seconds a client socket may stay unwritable before it is disconnected
 
+# change-only push: a value is only sent when it moves by more than its deadband (set per collector),
+# or when nothing has been sent for HEARTBEAT_INTERVAL seconds (keeps liveness detection working)
+PUSH_MODES = ['always', 'change']
+HEARTBEAT_INTERVAL = 5.0
+# longest a display may go without a message: main.py marks its value stale after 6s and drops
+# the connection after 15s (STALE_MS/DEAD_MS), so --heartbeat and SUB rates can't go past it
+MAX_SILENCE = 5.0
+
+# Binary framed protocol (optional, text lines stay the default for old firmware)
+# the client picks it by sending one handshake byte, 0xB0 | version, after connecting.
+# every frame is FRAME_STRUCT: magic, version, metric id, flags, sequence number,
+# server timestamp (ms, wraps at 2^32) and the value as signed fixed point (value * FIXED_POINT_SCALE)
+# version 2 adds batch frames: metric id METRIC_BATCH, flags = entry count, value unused,
+# followed by that many BATCH_ENTRY_STRUCT (metric id, fixed point value) - every metric in one frame.
+# must match main.py
+PROTOCOL_VERSION = 2
+HANDSHAKE_BASE = 0xB0
+FRAME_MAGIC = 0xA5
+FRAME_STRUCT = struct.Struct('>BBBBIIi')
+BATCH_ENTRY_STRUCT = struct.Struct('>Bi')
+FIXED_POINT_SCALE = 100
+METRIC_HELLO = 0  # sent once after the handshake, value is the server's highest protocol version
+METRIC_BATCH = 255
+METRIC_IDS = {
+    'cpu': 1,
+    'ram': 2,
+    'swap': 3,
+    'load1': 4,
+    'load5': 5,
+    'load15': 6,
+    'net_rx': 7,
+    'net_tx': 8,
+    'disk_read': 9,
+    'disk_write': 10,
+    'temp': 11,
+}
+METRIC_ID_RANGES = {
+    'core': 64,  # core0..core63 -> 64..127
+    'temp': 128,  # temp0..temp63 -> 128..191
+}
+
+# Server-rendered segments (optional): the client sends SEGMENT_HANDSHAKE instead and gets the four
+# finished segment bytes, dots and suffix letter applied, so it only copies them to the display.
+# every message is SEGMENT_STRUCT: magic, 4 segment bytes, then a check byte (xor of the bytes before it).
+# formatting rules live here, SEGMENT_CODES must match SEG8Code in main.py
+SEGMENT_HANDSHAKE = 0xC1
+SEGMENT_MAGIC = 0x5A
+SEGMENT_STRUCT = struct.Struct('>B4s')
+SEGMENT_TRACE_MAGIC = 0x5B  # traced form: SEGMENT_TRACE_STRUCT adds sequence number and sample time (ms)
+SEGMENT_TRACE_STRUCT = struct.Struct('>B4sII')
+SEGMENT_CODES = (0x3F, 0x06, 0x5B, 0x4F, 0x66, 0x6D, 0x7D, 0x07, 0x7F, 0x6F,  # 0-9
+                 0x77, 0x7C, 0x39, 0x5E, 0x79, 0x71,  # A-F
+                 0x40)  # MINUS_DIGIT: segment G alone
+MINUS_DIGIT = 16
+SEGMENT_DOT = 0x80
+
+# Latency tracing (optional): a client that sends "TRACE" gets a sequence number and sample time on every
+# message - binary frames always carry them, text lines become "45C <seq> <sample ms>", segment messages
+# SEGMENT_TRACE_STRUCT - and now and then answers "ACK <seq> <receive->display us> <receive->ack us>".
+# there is no shared clock, so send->receive is half of the round trip left after the time the client held the ack
+TRACE_STAGES = ('sample_to_send', 'send_to_receive', 'receive_to_display')
+TRACE_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+TRACE_PENDING = 64  # sent messages remembered per client to match acks against
+
+# logging runs on its own thread through a bounded queue, so a slow terminal never holds up sending.
+# per-send lines are only logged at debug level, otherwise each client gets one summary line
+# every LOG_SUMMARY_INTERVAL seconds (--stats-interval)
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+LOG_QUEUE_SIZE = 10000  # lines waiting to be written, newer lines are dropped (and counted) when full
+LOG_SUMMARY_INTERVAL = 60.0
+
+# UDP publish (--udp GROUP:PORT): one binary frame per snapshot, sent once whatever the number of listeners.
+# 224.0.0.0-239.255.255.255 is multicast, x.x.x.255 / 255.255.255.255 broadcast, anything else plain unicast.
+UDP_PORT = 9002
+UDP_TTL = 1  # multicast hops, 1 keeps it on the local network
+
+# Metric history: raw samples for the last HISTORY_RAW ticks plus min/max/avg rollup tiers of
+# (seconds per bucket, buckets kept) - 10 minutes of 1s, a day of 1min, two weeks of 1h.
+# a query uses the coarsest tier with at least HISTORY_RESOLUTION buckets in the window,
+# so it is accurate to about a tenth of the window and never scans more than a few hundred buckets
+HISTORY_RAW = 240
+HISTORY_TIERS = ((1, 600), (60, 1440), (3600, 336))
+HISTORY_RESOLUTION = 10
+HISTORY_AGGREGATES = ['min', 'max', 'avg']
+HISTORY_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Agents and aggregator: an agent connects to the aggregator's ingest port, sends "AGENT <name>\n" and then
+# one binary v2 batch frame (the display format) of its metrics per tick. A host that sends nothing for
+# AGENT_STALE seconds is left out until it comes back. Aggregates are metric@<one of AGENT_AGGREGATES>.
+AGGREGATE_PORT = 9003
+AGENT_STALE = 10.0
+AGENT_RETRY_MAX = 30.0  # agent reconnect backoff cap, seconds
+AGENT_AGGREGATES = ['max', 'min', 'avg', 'sum']
+
+# optional Prometheus text endpoint, off unless --metrics-port is given
+METRICS_HOST = '127.0.0.1'
+
+# how often the shared sampler collects a new set of values.
+# ticks run on a monotonic deadline schedule (tick n is due at start + n * interval) so the rate doesn't drift
+# with sampling time, a tick that is missed completely is skipped rather than run late
+TICK_INTERVAL = 0.25
+
+# when several metrics share one display they rotate every ROTATE_SECONDS
+ROTATE_SECONDS = 1.0
+
+# clients can subscribe to their own metrics and rate with "SUB cpu,ram 10" (Hz), MIN_RATE to MAX_RATE.
+# the sampler ticks as fast as the fastest subscriber needs and runs each collector only that often
+MAX_RATE = 20.0
+MIN_RATE = 1.0 / MAX_SILENCE
+# a tick or send may come this fraction of its interval early and still count as on time
+TIMING_SLACK = 0.1
+
+# immutable set of values collected during one sampler tick
+# seq increments every tick, values is a read-only mapping of metric name -> value.
+# timestamp is wall clock (history, wire protocol), monotonic is for scheduling sends
+Snapshot = namedtuple('Snapshot', ['seq', 'timestamp', 'values', 'monotonic'])
+
+log = logging.getLogger('pc_server')
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks the caller, lines that don't fit are counted and dropped"""
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+def setup_logging(level='info', queue_size=LOG_QUEUE_SIZE, stream=None):
+    """Send the log through a background writer thread, returns the listener (stop() flushes it)"""
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S'))
+    handler = DroppingQueueHandler(Queue(maxsize=max(1, queue_size)))
+    log.handlers = [handler]
+    log.setLevel(level.upper())
+    log.propagate = False
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    return listener
+
+class Histogram:
+    """Prometheus style histogram, counts per bucket are cumulated when rendered"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile (inf past the last one), None if empty"""
+        if not self.count:
+            return None
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= q * self.count:
+                return bound
+        return float('inf')
+
+# name -> (type, help, histogram buckets in seconds)
+TELEMETRY_METRICS = {
+    'collect_seconds': ('histogram', "Time taken to sample one collector",
+                        (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)),
+    'tick_seconds': ('histogram', "Time the sampler spent on one tick, TICK_INTERVAL is the budget",
+                     (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)),
+    'send_seconds': ('histogram', "Time spent handing data to one client's socket",
+                     (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)),
+    'tick_jitter_seconds': ('histogram', "How late the sampler woke up for each tick",
+                            (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)),
+    'tick_overruns_total': ('counter', "Sampler ticks that went over their time budget", None),
+    'ticks_skipped_total': ('counter', "Sampler ticks skipped because the previous one ran past them", None),
+    'accepts_total': ('counter', "Client connections accepted", None),
+    'client_errors_total': ('counter', "Client connections ended by an error", None),
+    'collector_errors_total': ('counter', "Collector samples that raised an error", None),
+    'trace_sample_to_send_seconds': ('histogram', "Traced clients: sample time to handing the value to the socket",
+                                     TRACE_BUCKETS),
+    'trace_send_to_receive_seconds': ('histogram', "Traced clients: socket to the display receiving it (half RTT)",
+                                      TRACE_BUCKETS),
+    'trace_receive_to_display_seconds': ('histogram', "Traced clients: received to shown on the display",
+                                         TRACE_BUCKETS),
+}
+
+class Telemetry:
+    """Counters and histograms for the hot paths, served by the /metrics endpoint.
+    Does nothing until enabled, so the server pays nothing when it isn't used.
+    """
+    prefix = 'pc_server_'
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(TELEMETRY_METRICS[name][2])
+            hist.observe(value)
+
+    def forget(self, **labels):
+        """Drop every series with these labels, e.g. a disconnected client"""
+        match = set(labels.items())
+        with self._lock:
+            for table in (self._counters, self._histograms):
+                for key in [k for k in table if match.issubset(k[1])]:
+                    del table[key]
+
+    def _labels(self, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    def render(self, gauges=()):
+        """Everything in the Prometheus text format, gauges is a list of (name, help, [(labels, value)])"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            for name, (kind, help_text, buckets) in TELEMETRY_METRICS.items():
+                full = self.prefix + name
+                lines.append('# HELP {} {}'.format(full, help_text))
+                lines.append('# TYPE {} {}'.format(full, kind))
+                if kind == 'counter':
+                    for (cname, labels), value in counters:
+                        if cname == name:
+                            lines.append('{}{} {}'.format(full, self._labels(labels), value))
+                    continue
+                for (hname, labels), hist in histograms:
+                    if hname != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(full, self._labels(labels, [('le', bound)]), cumulative))
+                    lines.append('{}_sum{} {}'.format(full, self._labels(labels), hist.sum))
+                    lines.append('{}_count{} {}'.format(full, self._labels(labels), hist.count))
+        for name, help_text, samples in gauges:
+            full = self.prefix + name
+            lines.append('# HELP {} {}'.format(full, help_text))
+            lines.append('# TYPE {} gauge'.format(full))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(full, self._labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+telemetry = Telemetry()
+
+class PsutilBackend:
+    """Metric backend using psutil"""
+    name = 'psutil'
+
+    def __init__(self):
+        import psutil
+        self.psutil = psutil
+
+    def cpu_percent(self):
+        # non-blocking, percent since the previous call (the collector's first read only primes it)
+        return self.psutil.cpu_percent(interval=None)
+
+    def ram_used_bytes(self):
+        return self.psutil.virtual_memory().used
+
+    def swap_used_bytes(self):
+        return self.psutil.swap_memory().used
+
+    def core_percents(self):
+        # non-blocking, percent since the previous call
+        return self.psutil.cpu_percent(percpu=True)
+
+    def loadavg(self):
+        return os.getloadavg()
+
+    def net_bytes(self):
+        total_rx = total_tx = 0
+        for name, counters in self.psutil.net_io_counters(pernic=True).items():
+            if name != 'lo':
+                total_rx += counters.bytes_recv
+                total_tx += counters.bytes_sent
+        return total_rx, total_tx
+
+    def disk_bytes(self):
+        counters = self.psutil.disk_io_counters()
+        if counters is None:
+            return 0, 0
+        return counters.read_bytes, counters.write_bytes
+
+    def temperatures(self):
+        if not hasattr(self.psutil, 'sensors_temperatures'):
+            return []
+        temps = []
+        for entries in self.psutil.sensors_temperatures().values():
+            temps.extend(entry.current for entry in entries)
+        return temps
+
+class ProcBackend:
+    """Built-in Linux backend that reads /proc directly, no psutil and no subprocesses.
+    /proc/stat and /proc/meminfo are opened once and re-read with a seek each tick,
+    CPU busy % is worked out from the jiffy deltas between two reads.
+    """
+    name = 'proc'
+
+    def __init__(self, proc_root='/proc', sys_root='/sys'):
+        self._stat = open(proc_root + '/stat', 'rb')
+        self._meminfo = open(proc_root + '/meminfo', 'rb')
+        self._loadavg = open(proc_root + '/loadavg', 'rb')
+        self._net_dev = open(proc_root + '/net/dev', 'rb')
+        self._diskstats = open(proc_root + '/diskstats', 'rb')
+        self._last_busy, self._last_total = self._cpu_jiffies()
+        self._last_cores = self._core_jiffies()
+        # whole physical disks only, partitions and stacked devices (dm-*, md*: their slaves/ lists
+        # the disks underneath) would count the same I/O twice
+        try:
+            self._disks = set(name for name in os.listdir(sys_root + '/block')
+                              if not name.startswith(('loop', 'ram', 'zram'))
+                              and not self._stacked(sys_root + '/block/' + name))
+        except OSError:
+            self._disks = set()
+        self._thermal = sorted(glob.glob(sys_root + '/class/thermal/thermal_zone*/temp'))
+
+    def close(self):
+        for f in (self._stat, self._meminfo, self._loadavg, self._net_dev, self._diskstats):
+            f.close()
+
+    def _stacked(self, device):
+        try:
+            return bool(os.listdir(device + '/slaves'))
+        except OSError:
+            return False
+
+    def _read(self, f):
+        f.seek(0)
+        return f.read()
+
+    def _busy_total(self, line):
+        """Return (busy, total) jiffies from one cpu line of /proc/stat"""
+        # user nice system idle iowait irq softirq steal (guest times are already in user/nice)
+        jiffies = [int(x) for x in line.split()[1:9]]
+        total = sum(jiffies)
+        idle = jiffies[3] + (jiffies[4] if len(jiffies) > 4 else 0)
+        return total - idle, total
+
+    def _cpu_jiffies(self):
+        """Return (busy, total) jiffies from the aggregate 'cpu' line of /proc/stat"""
+        data = self._read(self._stat)
+        return self._busy_total(data[:data.index(b'\n')])
+
+    def _core_jiffies(self):
+        """Return a list of (busy, total) jiffies, one per cpuN line of /proc/stat"""
+        cores = []
+        for line in self._read(self._stat).splitlines()[1:]:
+            if not line.startswith(b'cpu'):
+                break
+            cores.append(self._busy_total(line))
+        return cores
+
+    def core_percents(self):
+        cores = self._core_jiffies()
+        percents = []
+        for (busy, total), (last_busy, last_total) in zip(cores, self._last_cores):
+            d_total = total - last_total
+            percents.append(100.0 * (busy - last_busy) / d_total if d_total > 0 else 0.0)
+        self._last_cores = cores
+        return percents
+
+    def cpu_percent(self):
+        busy, total = self._cpu_jiffies()
+        d_busy = busy - self._last_busy
+        d_total = total - self._last_total
+        self._last_busy, self._last_total = busy, total
+        if d_total <= 0:
+            return 0.0
+        return 100.0 * d_busy / d_total
+
+    def meminfo(self):
+        """Return /proc/meminfo as a dict of name -> bytes"""
+        info = {}
+        for line in self._read(self._meminfo).splitlines():
+            parts = line.split()
+            if len(parts) >= 2:
+                info[parts[0].rstrip(b':').decode()] = int(parts[1]) * 1024
+        return info
+
+    def ram_used_bytes(self):
+        info = self.meminfo()
+        available = info.get('MemAvailable')
+        if available is None:
+            # kernels before 3.14 have no MemAvailable
+            available = info.get('MemFree', 0) + info.get('Buffers', 0) + info.get('Cached', 0)
+        return info.get('MemTotal', 0) - available
+
+    def swap_used_bytes(self):
+        info = self.meminfo()
+        return info.get('SwapTotal', 0) - info.get('SwapFree', 0)
+
+    def loadavg(self):
+        return tuple(float(x) for x in self._read(self._loadavg).split()[:3])
+
+    def net_bytes(self):
+        total_rx = total_tx = 0
+        for line in self._read(self._net_dev).splitlines()[2:]:
+            name, _, counters = line.partition(b':')
+            if name.strip() == b'lo':
+                continue
+            fields = counters.split()
+            total_rx += int(fields[0])
+            total_tx += int(fields[8])
+        return total_rx, total_tx
+
+    def disk_bytes(self):
+        read_sectors = written_sectors = 0
+        for line in self._read(self._diskstats).splitlines():
+            fields = line.split()
+            if fields[2].decode() in self._disks:
+                read_sectors += int(fields[5])
+                written_sectors += int(fields[9])
+        # diskstats always counts 512 byte sectors
+        return read_sectors * 512, written_sectors * 512
+
+    def temperatures(self):
+        temps = []
+        for path in self._thermal:
+            try:
+                with open(path, 'rb') as f:
+                    temps.append(int(f.read()) / 1000.0)
+            except (OSError, ValueError):
+                pass
+        return temps
+
+BACKENDS = {
+    'psutil': PsutilBackend,
+    'proc': ProcBackend,
+}
+
+# selected once at startup by select_backend()
+metric_backend = None
+
+def select_backend(name='auto'):
+    """Pick the metric backend once, 'auto' prefers psutil and falls back to /proc"""
+    global metric_backend
+    if name == 'auto':
+        try:
+            metric_backend = PsutilBackend()
+        except ImportError:
+            metric_backend = ProcBackend()
+    else:
+        metric_backend = BACKENDS[name]()
+    return metric_backend
 
 def get_cpu_usage():
     """Get current CPU usage percentage"""
+    if metric_backend is None:
+        select_backend()
     try:
-        # Try using psutil if available
-        import psutil
-        return int(psutil.cpu_percent(interval=0.1))
-    except ImportError:
-        # Fallback to simple method
-        try:
-            result = subprocess.run(['top', '-bn1'], capture_output=True, text=True)
-            lines = result.stdout.split('\n')
-            for line in lines:
-                if line.startswith('Cpu(s):'):
-                    # Parse the first value (user CPU)
-                    cpu_line = line.split(',')[0]
-                    user_cpu = cpu_line.split(':')[1].strip()
-                    return int(float(user_cpu.split('%')[0]))
-        except:
-            return 0
+        return int(metric_backend.cpu_percent())
+    except Exception as e:
+        log.error("CPU sample error: %s", e)
+        return 0
 
 def get_ram_usage():
     """Get current RAM usage in gigabytes with 1 decimal point"""
+    if metric_backend is None:
+        select_backend()
     try:
-        # Try using psutil if available
-        import psutil
-        used_bytes = psutil.virtual_memory().used
-        used_gb = used_bytes / (1024.0 ** 3)
+        used_gb = metric_backend.ram_used_bytes() / (1024.0 ** 3)
         return round(used_gb, 1)
-    except ImportError:
-        # Fallback to simple method
-        try:
-            result = subprocess.run(['free', '-b'], capture_output=True, text=True)
-            lines = result.stdout.split('\n')
-            for line in lines:
-                if line.startswith('Mem:'):
-                    # Parse memory usage in bytes
-                    parts = line.split()
-                    used_bytes = float(parts[2])
-                    used_gb = used_bytes / (1024.0 ** 3)
-                    return round(used_gb, 1)
-        except:
-            return 0.0
+    except Exception as e:
+        log.error("RAM sample error: %s", e)
+        return 0.0
+
+class Rate:
+    """Change per second between samples. For a cumulative counter a drop means it was reset and
+    gives 0 rather than a negative rate, as the 'rate' filter stage (counter=False) any change counts
+    """
+    def __init__(self, counter=False):
+        self.counter = counter
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.last_time = None
+
+    def update(self, value, now=None):
+        now = time.monotonic() if now is None else now
+        rate = 0.0
+        if self.last is not None and now > self.last_time and (value >= self.last or not self.counter):
+            rate = (value - self.last) / (now - self.last_time)
+        self.last, self.last_time = value, now
+        return rate
+
+class EmaStage:
+    """Exponential moving average, alpha is the weight of the newest sample"""
+    def __init__(self, alpha=0.3):
+        if not 0 < alpha <= 1:
+            raise ValueError("ema alpha must be above 0 and at most 1")
+        self.alpha = alpha
+        self.reset()
 
-def handle_client(client_socket, address, mode='cpu'):
-    """Handle a connected client"""
-    print("Client connected from:", address)
+    def reset(self):
+        self.value = None
+
+    def update(self, value, now):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+class MedianStage:
+    """Median of the last size samples, throws away single sample spikes"""
+    def __init__(self, size=5):
+        self.size = int(size)
+        if self.size < 1:
+            raise ValueError("median size must be at least 1")
+        self.reset()
+
+    def reset(self):
+        self.window = deque(maxlen=self.size)  # arrival order
+        self.ordered = []  # the same values, sorted
+
+    def update(self, value, now):
+        if len(self.window) == self.size:
+            del self.ordered[bisect.bisect_left(self.ordered, self.window[0])]
+        self.window.append(value)
+        bisect.insort(self.ordered, value)
+        middle = len(self.ordered) // 2
+        if len(self.ordered) % 2:
+            return self.ordered[middle]
+        return (self.ordered[middle - 1] + self.ordered[middle]) / 2.0
+
+class PeakHoldStage:
+    """Shows the highest value for hold seconds before following the input down again"""
+    def __init__(self, hold=2.0):
+        self.hold = hold
+        self.reset()
+
+    def reset(self):
+        self.peak = None
+        self.peak_at = 0.0
+
+    def update(self, value, now):
+        if self.peak is None or value >= self.peak or now - self.peak_at >= self.hold:
+            self.peak = value
+            self.peak_at = now
+        return self.peak
+
+# --filter stage names -> class, the optional ':N' argument is passed to the constructor
+FILTER_STAGES = {
+    'ema': EmaStage,
+    'median': MedianStage,
+    'peak': PeakHoldStage,
+    'rate': Rate,  # e.g. how fast RAM use is growing
+}
+
+class FilterChain:
+    """Stages applied in order to every new sample of one metric, each keeps a fixed amount of state.
+    spec is a list of (stage class, constructor args), so one --filter can build a chain per metric
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.stages = [kind(*args) for kind, args in spec]
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def update(self, value, now):
+        for stage in self.stages:
+            value = stage.update(value, now)
+        return value
+
+class Collector:
+    """A registered metric source.
+    name: metric name, or prefix for collectors that provide numbered metrics (core -> core0, core1..)
+    provides: the fixed metric names it produces, defaults to just its name, () for a prefix only collector
+    interval: seconds between samples, budget: seconds one sample is allowed to take,
+    collectors that go over budget are moved to their own thread so cheap metrics never wait for them.
+    """
+    def __init__(self, name, func, interval, budget, suffix='', deadband=0.0, digits=1, unit='', delta=False,
+                 provides=None):
+        self.name = name
+        self.provides = (name,) if provides is None else tuple(provides)
+        self.func = func
+        self.interval = interval
+        self.budget = budget
+        self.suffix = suffix
+        self.deadband = deadband
+        self.digits = digits
+        self.unit = unit  # for log messages
+        self.delta = delta  # value is a difference between two reads, first read only primes it
+        self.cost = 0.0  # smoothed seconds per sample
+        self.samples = 0
+        self.filter_specs = {}  # metric, or this collector's name for all its metrics -> FilterChain spec
+        self.filters = {}  # metric -> FilterChain, built from filter_specs on the metric's first sample
+
+    def format(self, value):
+        """Round a raw value the way it is shown on the display"""
+        if self.digits == 0:
+            return int(value)
+        return round(value, self.digits)
+
+    def sample(self):
+        """Run the collector once, return a dict of metric name -> value"""
+        started = time.perf_counter()
+        result = self.func()
+        elapsed = time.perf_counter() - started
+        telemetry.observe('collect_seconds', elapsed, collector=self.name)
+        self.cost = elapsed if not self.samples else self.cost * 0.8 + elapsed * 0.2
+        self.samples += 1
+        if not isinstance(result, dict):
+            result = {self.name: result}
+        if self.filter_specs:
+            now = time.monotonic()
+            for name in result:
+                chain = self.filters.get(name)
+                if chain is None:
+                    spec = self.filter_specs.get(name, self.filter_specs.get(self.name))
+                    if spec is None:
+                        continue
+                    chain = self.filters[name] = FilterChain(spec)
+                result[name] = chain.update(result[name], now)
+        return dict((name, self.format(value)) for name, value in result.items())
+
+    def reset_filters(self):
+        """Forget filter state, e.g. after nobody wanted the metric for a while"""
+        for chain in self.filters.values():
+            chain.reset()
+
+COLLECTORS = {}
+
+def collector(name, interval=TICK_INTERVAL, budget=0.02, suffix='', deadband=0.0, digits=1, unit='', delta=False,
+              provides=None):
+    """Decorator registering a function as the collector for metric 'name'"""
+    def register(func):
+        COLLECTORS[name] = Collector(name, func, interval, budget, suffix, deadband, digits, unit, delta, provides)
+        return func
+    return register
+
+def find_collector(metric):
+    """Return the collector that provides metric, or None"""
+    if '@' in metric:
+        return remote_collector(metric.split('@', 1)[0])
+    for coll in COLLECTORS.values():
+        if metric in coll.provides:
+            return coll
+    for coll in COLLECTORS.values():
+        if metric.startswith(coll.name) and metric[len(coll.name):].isdigit():
+            return coll
+    return None
+
+def metric_suffix(metric):
+    coll = find_collector(metric)
+    return coll.suffix if coll else ''
+
+def parse_metrics(text):
+    """Parse a display mode: 'both' or a comma separated list of metric names"""
+    text = text.lower()
+    if text == 'both':
+        return ['cpu', 'ram']
+    metrics = [name.strip() for name in text.split(',') if name.strip()]
+    for metric in metrics:
+        if find_collector(metric) is None:
+            raise argparse.ArgumentTypeError("unknown metric '{}'".format(metric))
+    if not metrics:
+        raise argparse.ArgumentTypeError("no metric given")
+    return metrics
+
+@collector('cpu', suffix='C', deadband=1.0, digits=0, unit='%', delta=True)
+def collect_cpu():
+    return get_cpu_usage()
+
+@collector('ram', deadband=0.1, unit=' GB')
+def collect_ram():
+    return get_ram_usage()
+
+@collector('swap', interval=1.0, deadband=0.1, unit=' GB')
+def collect_swap():
+    return metric_backend.swap_used_bytes() / (1024.0 ** 3)
+
+@collector('core', suffix='C', deadband=1.0, digits=0, unit='%', delta=True, provides=())
+def collect_cores():
+    return dict(('core{}'.format(i), percent) for i, percent in enumerate(metric_backend.core_percents()))
+
+@collector('load', interval=1.0, deadband=0.1, digits=2, provides=('load1', 'load5', 'load15'))
+def collect_load():
+    load1, load5, load15 = metric_backend.loadavg()
+    return {'load1': load1, 'load5': load5, 'load15': load15}
+
+_net_rates = (Rate(counter=True), Rate(counter=True))
+
+@collector('net', interval=1.0, suffix='B', deadband=0.1, unit=' MB/s', delta=True,
+           provides=('net_rx', 'net_tx'))
+def collect_net():
+    """Network throughput in MB/s, all interfaces except loopback"""
+    rx, tx = metric_backend.net_bytes()
+    return {
+        'net_rx': _net_rates[0].update(rx) / (1024.0 ** 2),
+        'net_tx': _net_rates[1].update(tx) / (1024.0 ** 2),
+    }
+
+_disk_rates = (Rate(counter=True), Rate(counter=True))
+
+@collector('disk', interval=1.0, suffix='D', deadband=0.1, unit=' MB/s', delta=True,
+           provides=('disk_read', 'disk_write'))
+def collect_disk():
+    """Disk I/O in MB/s, whole disks only"""
+    read, written = metric_backend.disk_bytes()
+    return {
+        'disk_read': _disk_rates[0].update(read) / (1024.0 ** 2),
+        'disk_write': _disk_rates[1].update(written) / (1024.0 ** 2),
+    }
+
+@collector('temp', interval=2.0, budget=0.05, suffix='E', deadband=1.0, digits=0, unit='C')
+def collect_temps():
+    """Hottest sensor as 'temp', every sensor as temp0, temp1.."""
+    temps = metric_backend.temperatures()
+    values = dict(('temp{}'.format(i), t) for i, t in enumerate(temps))
+    values['temp'] = max(temps) if temps else 0.0
+    return values
+
+def metric_id(metric):
+    """Binary protocol id for a metric name, None if it has no id"""
+    metric = metric.split('@', 1)[0]  # cpu@web1 shows as cpu
+    if metric in METRIC_IDS:
+        return METRIC_IDS[metric]
+    for prefix, base in METRIC_ID_RANGES.items():
+        index = metric[len(prefix):]
+        if metric.startswith(prefix) and index.isdigit() and int(index) < 64:
+            return base + int(index)
+    return None
+
+def check_binary_metrics(metrics):
+    """Raise ArgumentTypeError for a metric the binary protocol has no id for (core64 and up)"""
+    for metric in metrics:
+        if metric_id(metric) is None:
+            raise argparse.ArgumentTypeError("metric '{}' has no binary protocol id".format(metric))
+
+def metric_name(number):
+    """Metric name for a binary protocol id, the reverse of metric_id()"""
+    for name, fixed in METRIC_IDS.items():
+        if fixed == number:
+            return name
+    for prefix, base in METRIC_ID_RANGES.items():
+        if base <= number < base + 64:
+            return prefix + str(number - base)
+    return None
+
+def format_digits(value, suffix=''):
+    """Digits (0-15, MINUS_DIGIT) for the 4 display positions and the dot position (-1 for none).
+    XX.X below 100, XXX0 from 100, and with a hex suffix letter XXX<suffix> / 0XX<suffix>.
+    Negative values (a gauge through the rate filter) show a leading minus: -XX.X / -XXX / -XX<suffix>
+    """
     try:
-        toggle = True  # For 'both' mode - start with CPU
-        toggle_counter = 0  # local counter: 4 * 0.25s = 1s
+        value = float(value)
+        if value < 0:
+            magnitude = -value
+            if suffix and suffix.upper() in '0123456789ABCDEF':
+                whole = int(magnitude) % 100
+                return (MINUS_DIGIT, whole // 10, whole % 10, int(suffix, 16)), -1
+            if magnitude >= 100:
+                whole = int(magnitude) % 1000
+                return (MINUS_DIGIT, whole // 100, (whole // 10) % 10, whole % 10), -1
+            tenths = int(magnitude * 10) % 1000
+            return (MINUS_DIGIT, tenths // 100, (tenths // 10) % 10, tenths % 10), 2
+        if suffix and suffix.upper() in '0123456789ABCDEF':
+            whole = int(value) % (1000 if value >= 100 else 100)
+            return (whole // 100, (whole // 10) % 10, whole % 10, int(suffix, 16)), -1
+        if value >= 100:
+            whole = int(value) % 1000
+            return (whole // 100, (whole // 10) % 10, whole % 10, 0), -1
+        tenths = int(value * 10) % 1000
+        return (0, tenths // 100, (tenths // 10) % 10, tenths % 10), 2
+    except (TypeError, ValueError, OverflowError):
+        return (0, 0, 0, 0), -1
+
+def render_segments(value, suffix=''):
+    """The 4 segment bytes the display shows for a value, dots and suffix applied"""
+    digits, dot = format_digits(value, suffix)
+    segments = bytearray(SEGMENT_CODES[digit] for digit in digits)
+    if dot >= 0:
+        segments[dot] |= SEGMENT_DOT
+    return bytes(segments)
+
+def encode_segments(segments, trace=None):
+    """Pack 4 segment bytes into one fixed size message, trace is (seq, sample time) for the traced form"""
+    if trace is None:
+        message = SEGMENT_STRUCT.pack(SEGMENT_MAGIC, segments)
+    else:
+        message = SEGMENT_TRACE_STRUCT.pack(SEGMENT_TRACE_MAGIC, segments, trace[0], int(trace[1] * 1000) & 0xFFFFFFFF)
+    check = 0
+    for byte in message:
+        check ^= byte
+    return message + bytes((check,))
+
+class HostTable:
+    """Newest values pushed by every agent, shared by the ingest side and the sampler"""
+    def __init__(self, stale=AGENT_STALE):
+        self.stale = stale
+        self._lock = threading.Lock()
+        self._hosts = {}  # name -> (time of last update, {metric: value})
+
+    def update(self, host, values, now=None):
+        with self._lock:
+            self._hosts[host] = (now or time.time(), values)
+
+    def values(self, base, now=None):
+        """base@host for every live host that has it, plus base@max/min/avg/sum across them"""
+        now = now or time.time()
+        found = {}
+        with self._lock:
+            for host, (seen, values) in self._hosts.items():
+                if now - seen <= self.stale and base in values:
+                    found[host] = values[base]
+        result = dict(('{}@{}'.format(base, host), value) for host, value in found.items())
+        if found:
+            total = sum(found.values())
+            result[base + '@max'] = max(found.values())
+            result[base + '@min'] = min(found.values())
+            result[base + '@avg'] = total / len(found)
+            result[base + '@sum'] = total
+        return result
+
+    def stats(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            return dict((host, round(now - seen, 1)) for host, (seen, values) in self._hosts.items())
+
+hosts = HostTable()
+REMOTE_COLLECTORS = {}  # base metric -> Collector reading it from the host table
+
+def remote_collector(base):
+    """Collector for base@host metrics, reads the aggregator's host table and formats like the local one"""
+    if base not in REMOTE_COLLECTORS:
+        local = find_collector(base)
+        if local is None:
+            return None
+        REMOTE_COLLECTORS[base] = Collector(
+            base + '@', lambda: hosts.values(base), TICK_INTERVAL, budget=0.05, suffix=local.suffix,
+            deadband=local.deadband, digits=local.digits, unit=local.unit, provides=())
+    return REMOTE_COLLECTORS[base]
+
+class FrameReader:
+    """Splits received bytes into binary frames, the pc_server side of main.py's FrameDecoder"""
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        """Add bytes, return [(metric_id, value)] with batch entries flattened, in arrival order"""
+        self.buffer += data
+        values = []
+        while len(self.buffer) >= FRAME_STRUCT.size:
+            if self.buffer[0] != FRAME_MAGIC:
+                pos = self.buffer.find(bytes([FRAME_MAGIC]), 1)
+                self.buffer = self.buffer[pos:] if pos > 0 else b''
+                continue
+            magic, version, frame_id, flags, seq, timestamp, raw = FRAME_STRUCT.unpack_from(self.buffer)
+            size = FRAME_STRUCT.size
+            if frame_id == METRIC_BATCH:
+                size += flags * BATCH_ENTRY_STRUCT.size
+                if len(self.buffer) < size:
+                    break
+                for entry in BATCH_ENTRY_STRUCT.iter_unpack(self.buffer[FRAME_STRUCT.size:size]):
+                    values.append((entry[0], entry[1] / FIXED_POINT_SCALE))
+            elif frame_id != METRIC_HELLO:
+                values.append((frame_id, raw / FIXED_POINT_SCALE))
+            self.buffer = self.buffer[size:]
+        return values
+
+class CollectorWorker:
+    """Runs one expensive collector on its own thread at its own interval"""
+    def __init__(self, coll, latest=None):
+        self.collector = coll
+        self.interval = coll.interval
+        self.latest = latest or {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='collector-' + coll.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.latest = self.collector.sample()
+            except Exception as e:
+                log.error("Collector '%s' error: %s", self.collector.name, e)
+                telemetry.inc('collector_errors_total', collector=self.collector.name)
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stop(self):
+        self._stop.set()
+
+class Sampler:
+    """Single background sampler shared by every connected client.
+    Collects each metric once per tick and publishes an immutable Snapshot,
+    clients only ever read the latest snapshot and never sample on their own.
+    """
+    def __init__(self, interval=TICK_INTERVAL, demand=None):
+        self.base_interval = interval  # tick when nobody asks for anything faster
+        self.interval = interval  # current tick, follows the fastest collector wanted
+        # callable returning {metric name: seconds between samples, or None for the collector's own}
+        # for the metrics clients want, None = every collector at its own interval
+        self.demand = demand
+        self.snapshot = None
+        self.next_tick_at = time.monotonic()  # deadline of the next tick
+        self._results = {}  # collector name -> last sampled values
+        self._due = {}  # collector name -> time.monotonic() the next sample is due
+        self._workers = {}  # collector name -> CollectorWorker for collectors over budget
+        self._cond = threading.Condition()
+        self._thread = None
+        self._listeners = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.overruns = 0  # ticks whose work took longer than the interval
+        self.skipped = 0  # deadlines dropped because a tick ran past them
+        self.jitter_max = 0.0  # seconds a tick started after its deadline
+        self.jitter_total = 0.0
+
+    def stats(self):
+        """Tick schedule statistics since the last reset_stats()"""
+        return {
+            'interval_ms': round(self.interval * 1000, 1),
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'jitter_avg_ms': round(self.jitter_total / self.ticks * 1000, 2) if self.ticks else 0.0,
+            'jitter_max_ms': round(self.jitter_max * 1000, 2),
+        }
+
+    def start(self):
+        """Start the sampler thread (once)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sampler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def add_listener(self, callback):
+        """Call callback(snapshot) from the sampler thread on every new snapshot"""
+        self._listeners = self._listeners + [callback]
+
+    def remove_listener(self, callback):
+        self._listeners = [cb for cb in self._listeners if cb != callback]
+
+    def wanted_collectors(self):
+        """[(collector, seconds between samples)] for every collector at least one connected client needs,
+        sampled as often as the most demanding of them asks for
+        """
+        if self.demand is None:
+            return [(coll, coll.interval) for coll in COLLECTORS.values()]
+        wanted = {}
+        for metric, interval in self.demand().items():
+            coll = find_collector(metric)
+            if coll is None:
+                continue
+            interval = max(1.0 / MAX_RATE, interval or coll.interval)
+            if coll.name not in wanted or interval < wanted[coll.name][1]:
+                wanted[coll.name] = (coll, interval)
+        return list(wanted.values())
+
+    def collect(self):
+        """Run every wanted collector that is due, return the merged values"""
+        now = time.monotonic()  # due times must not follow wall clock steps
+        wanted = self.wanted_collectors()
+        # tick as fast as the fastest collector needs, but never slower than the usual tick
+        self.interval = min([self.base_interval] + [interval for coll, interval in wanted])
+        values = {}
+        for coll, interval in wanted:
+            worker = self._workers.get(coll.name)
+            if worker is not None:
+                # expensive collector, runs on its own thread - just take its latest result
+                worker.interval = interval
+                values.update(worker.latest)
+                continue
+            if now >= self._due.get(coll.name, 0):
+                primed = coll.name in self._results
+                try:
+                    result = coll.sample()
+                except Exception as e:
+                    log.error("Collector '%s' error: %s", coll.name, e)
+                    telemetry.inc('collector_errors_total', collector=coll.name)
+                    result = {}
+                if coll.delta and not primed:
+                    # first read after being idle covers the whole idle period, take a fresh one next tick
+                    coll.reset_filters()
+                    self._results[coll.name] = {}
+                    self._due[coll.name] = now + self.interval
+                    continue
+                self._results[coll.name] = result
+                # due a little early, so a collector running every tick isn't pushed back by tick jitter
+                self._due[coll.name] = now + interval - self.interval * TIMING_SLACK
+                if coll.cost > coll.budget:
+                    log.warning("Collector '%s' took %.0fms (budget %.0fms), moving it to its own thread",
+                                coll.name, coll.cost * 1000, coll.budget * 1000)
+                    self._workers[coll.name] = CollectorWorker(coll, result)
+            values.update(self._results.get(coll.name, {}))
+
+        # forget collectors nobody wants any more, so they start fresh next time
+        wanted_names = set(coll.name for coll, interval in wanted)
+        for name in list(self._results):
+            if name not in wanted_names:
+                del self._results[name]
+                self._due.pop(name, None)
+                coll = COLLECTORS.get(name) or REMOTE_COLLECTORS.get(name.rstrip('@'))
+                if coll is not None:
+                    coll.reset_filters()
+        for name in list(self._workers):
+            if name not in wanted_names:
+                self._workers.pop(name).stop()
+        return values
+
+    def _run(self):
+        seq = 0
+        deadline = time.monotonic()
+        while True:
+            # wait for the deadline of this tick, independent of how long the previous one took
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            started = time.monotonic()
+            jitter = started - deadline
+            self.ticks += 1
+            self.jitter_total += jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+            telemetry.observe('tick_jitter_seconds', jitter)
+
+            interval = self.interval
+            try:
+                values = self.collect()
+            except Exception as e:
+                log.error("Sampler error: %s", e)
+                values = {}
+            seq += 1
+            # wall clock time for the history and the wire protocol, monotonic for client send schedules
+            snapshot = Snapshot(seq, time.time(), MappingProxyType(values), time.monotonic())
+            with self._cond:
+                self.snapshot = snapshot
+                self._cond.notify_all()
+            for callback in self._listeners:
+                try:
+                    callback(snapshot)
+                except Exception as e:
+                    log.error("Sampler listener error: %s", e)
+
+            finished = time.monotonic()
+            telemetry.observe('tick_seconds', finished - started)
+            if finished - started > interval:
+                self.overruns += 1
+                telemetry.inc('tick_overruns_total')
+            if self.interval != interval:
+                deadline = started  # collect() changed the tick length, restart the schedule from this tick
+            deadline += self.interval
+            if finished >= deadline:
+                # ran past one or more deadlines: skip them instead of running late ticks back to back
+                missed = int((finished - deadline) / self.interval) + 1
+                deadline += missed * self.interval
+                self.skipped += missed
+                telemetry.inc('ticks_skipped_total', missed)
+            self.next_tick_at = deadline
+
+    def until_next_tick(self):
+        """Seconds until the next tick is due, 0 if it is already late"""
+        return max(0.0, self.next_tick_at - time.monotonic())
+
+    def wait_for_next(self, last_seq, timeout=None):
+        """Block until a snapshot newer than last_seq is published, return it
+        (or the current snapshot if the timeout expires)
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.snapshot is not None and self.snapshot.seq > last_seq,
+                timeout
+            )
+            return self.snapshot
+
+class Rollup:
+    """Fixed size ring of min/max/sum/count buckets, one per period seconds"""
+    def __init__(self, period, size):
+        self.period = period
+        self.size = size
+        self.bucket = array.array('q', [-1]) * size  # bucket number (time // period) each slot holds
+        self.min = array.array('f', [0.0]) * size
+        self.max = array.array('f', [0.0]) * size
+        self.sum = array.array('d', [0.0]) * size
+        self.count = array.array('L', [0]) * size
+
+    def add(self, timestamp, value):
+        bucket = int(timestamp // self.period)
+        slot = bucket % self.size
+        if self.bucket[slot] != bucket:
+            # slot held an older bucket, start it again
+            self.bucket[slot] = bucket
+            self.min[slot] = self.max[slot] = self.sum[slot] = value
+            self.count[slot] = 1
+            return
+        if value < self.min[slot]:
+            self.min[slot] = value
+        if value > self.max[slot]:
+            self.max[slot] = value
+        self.sum[slot] += value
+        self.count[slot] += 1
+
+    def covers(self, window):
+        return self.period * self.size >= window
+
+    def query(self, start, end):
+        """(min, max, sum, count) of the buckets overlapping start..end, count is 0 if there are none"""
+        first = int(start // self.period)
+        last = int(end // self.period)
+        first = max(first, last - self.size + 1)
+        low, high, total, count = float('inf'), float('-inf'), 0.0, 0
+        for bucket in range(first, last + 1):
+            slot = bucket % self.size
+            if self.bucket[slot] != bucket:
+                continue  # nothing sampled then
+            low = min(low, self.min[slot])
+            high = max(high, self.max[slot])
+            total += self.sum[slot]
+            count += self.count[slot]
+        return low, high, total, count
+
+class MetricHistory:
+    """Raw sample ring and rollup tiers of one metric, memory is fixed when it is created"""
+    def __init__(self, raw=HISTORY_RAW, tiers=HISTORY_TIERS):
+        self.times = array.array('d', [0.0]) * raw
+        self.values = array.array('f', [0.0]) * raw
+        self.index = 0
+        self.filled = 0
+        self.tiers = [Rollup(period, size) for period, size in tiers]
+
+    def add(self, timestamp, value):
+        self.times[self.index] = timestamp
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.times)
+        self.filled = min(self.filled + 1, len(self.times))
+        for tier in self.tiers:
+            tier.add(timestamp, value)
+
+    def raw_query(self, start, end):
+        low, high, total, count = float('inf'), float('-inf'), 0.0, 0
+        for i in range(self.filled):
+            if start <= self.times[i] <= end:
+                value = self.values[i]
+                low = min(low, value)
+                high = max(high, value)
+                total += value
+                count += 1
+        return low, high, total, count
+
+    def query(self, aggregate, window, now):
+        """min, max or avg over the last window seconds, None if nothing was recorded then"""
+        tier = None
+        for candidate in self.tiers:
+            if candidate.covers(window) and window >= candidate.period * HISTORY_RESOLUTION:
+                tier = candidate  # tiers go from fine to coarse, keep the coarsest that qualifies
+        if tier is not None:
+            low, high, total, count = tier.query(now - window, now)
+        elif window < self.tiers[0].period * HISTORY_RESOLUTION:
+            low, high, total, count = self.raw_query(now - window, now)
+        else:
+            # longer than the coarsest tier keeps, answer with what there is
+            low, high, total, count = self.tiers[-1].query(now - window, now)
+        if not count:
+            return None
+        if aggregate == 'min':
+            return low
+        if aggregate == 'max':
+            return high
+        return total / count
+
+class History:
+    """History of every metric the sampler produces, fed from the sampler thread"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # metric -> MetricHistory
+
+    def record(self, snapshot):
+        """Sampler listener"""
+        with self._lock:
+            for metric, value in snapshot.values.items():
+                store = self._metrics.get(metric)
+                if store is None:
+                    store = self._metrics[metric] = MetricHistory()
+                store.add(snapshot.timestamp, value)
+
+    def query(self, metric, aggregate, window, now=None):
+        """min/max/avg of metric over the last window seconds, or None"""
+        now = time.time() if now is None else now
+        with self._lock:
+            store = self._metrics.get(metric)
+            if store is None:
+                return None
+            return store.query(aggregate, window, now)
+
+history = History()
+
+def parse_window(text):
+    """Window length like 300, 90s, 5m, 1h or 2d, in seconds"""
+    text = text.strip().lower()
+    scale = HISTORY_UNITS.get(text[-1:], None)
+    number = text[:-1] if scale else text
+    seconds = float(number) * (scale or 1)
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError("window must be a positive number")
+    return seconds
+
+class SendQueue:
+    """Bounded latest-value-wins queue of messages waiting to go to one client.
+    A slow client drops intermediate samples instead of buffering them, and the
+    time its socket has been unwritable is tracked so it can be evicted.
+    """
+    def __init__(self, maxlen=SEND_QUEUE_SIZE):
+        self._queue = deque(maxlen=max(1, maxlen))
+        self._control = deque()  # protocol replies, never dropped and sent before values
+        self.pending = b''  # partly written message, finished first to keep framing intact
+        self.blocked_since = None
+        self.dropped = 0
+        self.sent = 0
+        self.bytes_sent = 0
+
+    def __len__(self):
+        return len(self._queue) + len(self._control)
+
+    def put(self, message):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(message)
+
+    def put_control(self, message):
+        """Queue a protocol reply that must not be dropped"""
+        self._control.append(message)
+
+    def take(self):
+        """Remove and return everything queued as one bytes object"""
+        data = b''.join(self._control) + b''.join(self._queue)
+        self.sent += len(self._queue)
+        self.bytes_sent += len(data)
+        self._control.clear()
+        self._queue.clear()
+        return data
+
+    def flush(self, sock):
+        """Write as much as a non-blocking socket accepts, return True once everything is out"""
         while True:
-            # Get usage based on mode
-            if mode == 'ram':
-                usage = get_ram_usage()
-                # RAM usage doesn't use suffix - keep decimal format
-                data_to_send = "{}".format(usage)
-                print("Sent RAM usage: {} GB".format(usage))
-            elif mode == 'both':
-                # Alternate between CPU and RAM every second
-                if toggle:
-                    usage = get_cpu_usage()
-                    data_to_send = "{}C".format(usage)  # Suffix 'C' for CPU
-                    print("Sent CPU usage: {}%".format(usage))
+            if not self.pending:
+                if self._control:
+                    self.pending = self._control.popleft()
+                elif self._queue:
+                    self.pending = self._queue.popleft()
+                    self.sent += 1
                 else:
-                    usage = get_ram_usage()
-                    data_to_send = "{}".format(usage)  # RAM without suffix
-                    print("Sent RAM usage: {} GB".format(usage))
-                # increment local counter and flip every 4 loops (1 second)
-                toggle_counter += 1
-                if toggle_counter >= 4:
-                    toggle = not toggle
-                    toggle_counter = 0
-            else:  # 'cpu' mode (default)
-                usage = get_cpu_usage()
-                data_to_send = "{}C".format(usage)  # Suffix 'C' for CPU
-                print("Sent CPU usage: {}%".format(usage))
-            
+                    self.blocked_since = None
+                    return True
+            try:
+                written = sock.send(self.pending)
+            except (BlockingIOError, InterruptedError):
+                written = 0
+            self.bytes_sent += written
+            self.pending = self.pending[written:]
+            if self.pending:
+                self.mark_blocked()
+                return False
+
+    def mark_blocked(self, now=None):
+        if self.blocked_since is None:
+            self.blocked_since = time.monotonic() if now is None else now
+
+    def mark_writable(self):
+        self.blocked_since = None
+
+    def stalled(self, deadline, now=None):
+        """True if the socket has been unwritable for longer than deadline seconds"""
+        if self.blocked_since is None:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - self.blocked_since > deadline
+
+class LatencyTrace:
+    """End-to-end latency of one traced client: sample->send is timed here for every message,
+    send->receive and receive->display come from the client's ACKs
+    """
+    def __init__(self, label, queue_size=SEND_QUEUE_SIZE):
+        self.label = label
+        self.queue_size = max(1, queue_size)
+        self.pending = deque(maxlen=TRACE_PENDING)  # [seq, sample time, send time or None], time.monotonic()
+        self.histograms = dict((stage, Histogram(TRACE_BUCKETS)) for stage in TRACE_STAGES)
+        self.acks = 0
+        self.unmatched = 0  # acks for a message no longer remembered
+
+    def queued(self, seq, sample_time):
+        """A traced message went into the send queue"""
+        self.pending.append([seq, sample_time, None])
+        unsent = [entry for entry in self.pending if entry[2] is None]
+        if len(unsent) > self.queue_size:
+            self.pending.remove(unsent[0])  # the send queue drops it too
+
+    def sent(self, now):
+        """Everything queued so far has been handed to the socket"""
+        for entry in reversed(self.pending):
+            if entry[2] is not None:
+                break
+            entry[2] = now
+            self.observe('sample_to_send', now - entry[1])
+
+    def ack(self, seq, display_us, hold_us, now):
+        """The client showed message seq display_us after receiving it, and held the ack for hold_us"""
+        for entry in self.pending:
+            if entry[0] == seq and entry[2] is not None:
+                break
+        else:
+            self.unmatched += 1
+            return
+        self.acks += 1
+        self.observe('send_to_receive', max(0.0, (now - entry[2] - hold_us / 1e6) / 2))
+        self.observe('receive_to_display', display_us / 1e6)
+
+    def observe(self, stage, seconds):
+        self.histograms[stage].observe(seconds)
+        telemetry.observe('trace_{}_seconds'.format(stage), seconds, client=self.label)
+
+    def summary(self):
+        """e.g. 'sample->send avg 1.2ms p95 <2ms, ...', quantiles are histogram bucket bounds"""
+        parts = []
+        for stage in TRACE_STAGES:
+            hist = self.histograms[stage]
+            name = stage.replace('_to_', '->')
+            if not hist.count:
+                parts.append('{} -'.format(name))
+                continue
+            parts.append('{} avg {:.1f}ms p50 <{:g}ms p95 <{:g}ms'.format(
+                name, hist.sum / hist.count * 1000, hist.quantile(0.5) * 1000, hist.quantile(0.95) * 1000))
+        return '{}, {} acks'.format(', '.join(parts), self.acks)
+
+class ClientSession:
+    """Per-connection state, turns shared snapshots into the bytes to send.
+    Used by both server engines so they produce identical output.
+    """
+    def __init__(self, address, options):
+        self.address = address
+        self.label = "{}:{}".format(*address[:2]) if address else '?'
+        self.mode = options.mode
+        self.metrics = parse_metrics(options.mode)
+        self.push = options.push
+        self.deadbands = options.deadband
+        self.heartbeat = options.heartbeat
+        self.queue = SendQueue(options.queue_size)
+        self.queue_size = options.queue_size
+        self.trace = None  # LatencyTrace once the client asks for tracing
+        self.connected_at = time.time()
+        self.rotate_index = 0  # which of several metrics is showing, e.g. 'both' starts with CPU
+        self.rotated_at = None  # when the current metric came up
+        self.min_interval = None  # seconds between messages from a SUB rate, None = TICK_INTERVAL
+        self.next_send_at = 0.0  # rate limit deadline, time.monotonic()
+        self.protocol = 'text'
+        self.protocol_version = 0
+        self.frame_seq = 0
+        self.last_metric = None
+        self.last_values = {}  # metric -> last value sent, for change-only push
+        self.last_sent_at = 0.0
+        self.suppressed = 0  # values skipped by change-only push
+        self.last_sent = ()  # (metric, value) pairs of the latest message, for the log summary
+        self.command = b''  # partial text command line from the client
+
+    def stats(self):
+        """Per-client counters"""
+        return {
+            'address': self.label,
+            'mode': self.mode,
+            'protocol': self.protocol,
+            'connected': round(time.time() - self.connected_at, 1),
+            'sent': self.queue.sent,
+            'dropped': self.queue.dropped,
+            'suppressed': self.suppressed,
+            'bytes_sent': self.queue.bytes_sent,
+            'blocked': self.queue.blocked_since is not None,
+            'last': ', '.join('{} {}{}'.format(m.upper(), v, find_collector(m).unit) for m, v in self.last_sent) or '-',
+            'latency': self.trace.summary() if self.trace else None,
+        }
+
+    def feed(self, data):
+        """Handle bytes received from the client"""
+        for byte in data:
+            if byte & 0xF0 == HANDSHAKE_BASE and byte != HANDSHAKE_BASE:
+                self.negotiate(byte & 0x0F)
+            elif byte == SEGMENT_HANDSHAKE:
+                self.protocol = 'segments'
+                log.info("Client %s using server-rendered segments", self.label)
+            elif byte == 0x0A:
+                line, self.command = self.command, b''
+                self.command_line(line.decode('ascii', 'replace').strip())
+            elif byte < 0x80 and len(self.command) < 256:
+                self.command += bytes((byte,))
+            # anything else is ignored, old firmware never sends anything
+
+    def command_line(self, line):
+        """Answer a text command, replies are text lines whatever the protocol:
+        HIST <metric> <min|max|avg> <window>  ->  HIST cpu max 5m 87.0
+        SUB <metric>[,<metric>...] [<max rate Hz>]  ->  SUB ram 1
+        TRACE [on|off]  ->  TRACE on
+        ACK <seq> <receive->display us> <receive->ack us>  ->  no reply
+        """
+        words = line.split()
+        if not words:
+            return
+        verb = words[0].upper()
+        if verb == 'HIST':
+            reply = self.history_command(words)
+        elif verb == 'SUB':
+            reply = self.subscribe_command(words)
+        elif verb == 'TRACE':
+            reply = self.trace_command(words)
+        elif verb == 'ACK':
+            reply = self.ack_command(words)
+        else:
+            reply = "ERR unknown command '{}', expected HIST, SUB or TRACE".format(words[0])
+        if reply:
+            self.queue.put_control((reply + '\r\n').encode())
+
+    def history_command(self, words):
+        if len(words) != 4:
+            reply = "ERR expected HIST <metric> <{}> <window>".format('|'.join(HISTORY_AGGREGATES))
+        elif find_collector(words[1].lower()) is None:
+            reply = "ERR unknown metric '{}'".format(words[1])
+        elif words[2].lower() not in HISTORY_AGGREGATES:
+            reply = "ERR unknown aggregate '{}'".format(words[2])
+        else:
+            try:
+                window = parse_window(words[3])
+            except ValueError:
+                reply = "ERR bad window '{}'".format(words[3])
+            else:
+                value = history.query(words[1].lower(), words[2].lower(), window)
+                reply = "HIST {} {} {} {}".format(words[1].lower(), words[2].lower(), words[3],
+                                                  '-' if value is None else round(value, 2))
+        return reply
+
+    def subscribe_command(self, words):
+        if len(words) not in (2, 3):
+            return "ERR expected SUB <metric>[,<metric>...] [<rate Hz>]"
+        try:
+            metrics = parse_metrics(words[1])
+            if self.protocol == 'binary':
+                check_binary_metrics(metrics)
+        except argparse.ArgumentTypeError as e:
+            return "ERR {}".format(e)
+        rate = None
+        if len(words) == 3:
+            try:
+                rate = float(words[2])
+            except ValueError:
+                rate = 0
+            if not MIN_RATE <= rate <= MAX_RATE:
+                return "ERR rate must be {} to {} Hz".format(MIN_RATE, MAX_RATE)
+        self.subscribe(metrics, rate)
+        return "SUB {} {}".format(','.join(metrics), rate or 'tick')
+
+    def subscribe(self, metrics, rate=None):
+        """Switch this client to its own metrics and maximum rate (Hz, None = every tick)"""
+        self.metrics = metrics
+        self.mode = ','.join(metrics)
+        self.min_interval = 1.0 / rate if rate else None
+        self.rotate_index = 0
+        self.rotated_at = None
+        self.last_metric = None
+        self.last_values = {}
+        self.last_sent_at = 0.0
+        self.next_send_at = 0.0
+        log.info("Client %s subscribed to %s at %s", self.label, self.mode, '{}Hz'.format(rate) if rate else 'every tick')
+        clients.refresh()
+
+    def trace_command(self, words):
+        if len(words) > 2 or (len(words) == 2 and words[1].lower() not in ('on', 'off')):
+            return "ERR expected TRACE [on|off]"
+        if len(words) == 2 and words[1].lower() == 'off':
+            self.trace = None
+            return "TRACE off"
+        if self.trace is None:
+            self.trace = LatencyTrace(self.label, self.queue_size)
+            log.info("Client %s tracing latency", self.label)
+        return "TRACE on"
+
+    def ack_command(self, words):
+        if self.trace is None:
+            return "ERR not tracing, send TRACE first"
+        try:
+            seq, display_us, hold_us = [int(word) for word in words[1:]]
+        except ValueError:
+            return "ERR expected ACK <seq> <receive->display us> <receive->ack us>"
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Ack %s seq %d: shown %dus after arriving, ack held %dus", self.label, seq, display_us, hold_us)
+        self.trace.ack(seq, display_us, hold_us, time.monotonic())
+        return None
+
+    def mark_sent(self):
+        """Call once the engine has handed everything queued to the socket"""
+        if self.trace is not None:
+            self.trace.sent(time.monotonic())
+
+    def negotiate(self, client_version):
+        """Switch to binary frames using the highest version both sides speak"""
+        self.protocol = 'binary'
+        self.protocol_version = min(client_version, PROTOCOL_VERSION)
+        log.info("Client %s using binary protocol v%d", self.label, self.protocol_version)
+        self.queue.put_control(self.encode_frame(METRIC_HELLO, PROTOCOL_VERSION, time.time()))
+
+    def encode_frame(self, metric_id, value, timestamp, flags=0):
+        """Pack one binary frame"""
+        self.frame_seq = (self.frame_seq + 1) & 0xFFFFFFFF
+        return FRAME_STRUCT.pack(
+            FRAME_MAGIC, self.protocol_version, metric_id, flags, self.frame_seq,
+            int(timestamp * 1000) & 0xFFFFFFFF, int(round(value * FIXED_POINT_SCALE))
+        )
+
+    def encode_batch(self, metric_values, timestamp):
+        """Pack every (metric, value) into one batch frame, metrics without a binary id are left out"""
+        entries = [BATCH_ENTRY_STRUCT.pack(metric_id(metric), int(round(value * FIXED_POINT_SCALE)))
+                   for metric, value in metric_values if metric_id(metric) is not None]
+        return self.encode_frame(METRIC_BATCH, 0, timestamp, flags=len(entries)) + b''.join(entries)
+
+    def encodable(self, metric):
+        """False for a metric this client's protocol can't carry (binary ids stop at core63/temp63)"""
+        return self.protocol != 'binary' or metric_id(metric) is not None
+
+    def batching(self):
+        """True if this client takes all its metrics in one batch frame and rotates them itself"""
+        return self.protocol == 'binary' and self.protocol_version >= 2 and len(self.metrics) > 1
+
+    def encode(self, metric, value, snapshot):
+        """Encode one metric value in this client's protocol"""
+        if self.protocol == 'binary':
+            return self.encode_frame(metric_id(metric), value, snapshot.timestamp)
+        if self.trace is not None:
+            # text and segments have no sequence numbers of their own
+            self.frame_seq = (self.frame_seq + 1) & 0xFFFFFFFF
+            trace = (self.frame_seq, snapshot.timestamp)
+        else:
+            trace = None
+        if self.protocol == 'segments':
+            return encode_segments(render_segments(value, metric_suffix(metric)), trace)
+        if trace is not None:
+            return "{}{} {} {}\r\n".format(value, metric_suffix(metric), trace[0],
+                                           int(trace[1] * 1000) & 0xFFFFFFFF).encode()
+        # Suffix 'C' for CPU, RAM without suffix
+        return "{}{}\r\n".format(value, metric_suffix(metric)).encode()
+
+    def should_send(self, metric, value, now):
+        """Change-only push check, always True in 'always' push mode"""
+        last_value = self.last_values.get(metric)
+        if self.push == 'always' or last_value is None:
+            return True
+        if now - self.last_sent_at >= self.heartbeat:
+            return True
+        coll = find_collector(metric)
+        deadband = self.deadbands.get(metric, self.deadbands.get(coll.name))
+        if deadband is None:
+            deadband = coll.deadband
+        return abs(value - last_value) >= deadband
+
+    def next_batch(self, snapshot):
+        """Return one batch frame with every metric of this client, or None"""
+        metric_values = [(metric, snapshot.values[metric]) for metric in self.metrics
+                         if metric in snapshot.values and self.encodable(metric)]
+        if not metric_values:
+            return None
+        if not any(self.should_send(metric, value, snapshot.monotonic) for metric, value in metric_values):
+            self.suppressed += 1
+            return None
+        for metric, value in metric_values:
+            self.last_values[metric] = value
+        self.last_sent_at = snapshot.monotonic
+        self.last_sent = metric_values
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sent %s batch: %s", self.label, ', '.join('{} {}'.format(m.upper(), v) for m, v in metric_values))
+        message = self.encode_batch(metric_values, snapshot.timestamp)
+        if self.trace is not None:
+            self.trace.queued(self.frame_seq, snapshot.monotonic)
+        return message
+
+    def next_message(self, snapshot):
+        """Return the encoded message for this snapshot, or None if there is nothing worth sending"""
+        # clients that didn't subscribe keep the usual one message per TICK_INTERVAL when others tick faster.
+        # a deadline rather than time since the last send, so a rate that isn't a multiple of the tick averages out
+        min_interval = self.min_interval or TICK_INTERVAL
+        now = snapshot.monotonic
+        if now < self.next_send_at - min_interval * TIMING_SLACK:
+            return None
+        message = self.next_batch(snapshot) if self.batching() else self.next_value(snapshot)
+        if message is not None:
+            # only a send moves the deadline on. Sent a tick late it still advances from the deadline, so a
+            # rate that isn't a multiple of the tick averages out; a whole interval behind (or just connected
+            # or subscribed) it starts again from now
+            if now - self.next_send_at < min_interval:
+                self.next_send_at += min_interval
+            else:
+                self.next_send_at = now + min_interval
+        return message
+
+    def next_value(self, snapshot):
+        """Return the message for the one metric this client shows right now, or None"""
+        values = snapshot.values
+        now = snapshot.monotonic
+        # Pick the metric to show, several metrics take turns every ROTATE_SECONDS
+        if len(self.metrics) > 1:
+            if self.rotated_at is None:
+                self.rotated_at = now
+            elif now - self.rotated_at >= ROTATE_SECONDS * (1 - TIMING_SLACK):
+                self.rotate_index = (self.rotate_index + 1) % len(self.metrics)
+                self.rotated_at = now
+        metric = self.metrics[self.rotate_index % len(self.metrics)]
+
+        if metric not in values:
+            return None  # collector hasn't produced a value yet
+        if not self.encodable(metric):
+            return None  # a mode metric with no binary id, only text and segment clients can show it
+        usage = values[metric]
+        # always send when the display switches to another metric
+        if metric == self.last_metric and not self.should_send(metric, usage, now):
+            self.suppressed += 1
+            return None
+        self.last_metric = metric
+        self.last_values[metric] = usage
+        self.last_sent_at = now
+
+        self.last_sent = ((metric, usage),)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Sent %s %s usage: %s%s", self.label, metric.upper(), usage, find_collector(metric).unit)
+
+        message = self.encode(metric, usage, snapshot)
+        if self.trace is not None:
+            self.trace.queued(self.frame_seq, snapshot.monotonic)
+        return message
+
+class ClientRegistry:
+    """Thread safe set of connected sessions, shared by the server engines"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = set()
+        self._wanted = MappingProxyType({})
+
+    def add(self, session):
+        with self._lock:
+            self._sessions.add(session)
+            self._update_wanted()
+
+    def remove(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+            self._update_wanted()
+
+    def refresh(self):
+        """Call after a session changed its metrics or rate"""
+        with self._lock:
+            self._update_wanted()
+
+    def _update_wanted(self):
+        wanted = {}
+        for session in self._sessions:
+            for metric in session.metrics:
+                # clients that didn't subscribe to a rate get the collector's own interval
+                interval = session.min_interval or find_collector(metric).interval
+                wanted[metric] = min(interval, wanted.get(metric, interval))
+        self._wanted = MappingProxyType(wanted)
+
+    def wanted_metrics(self):
+        """{metric: seconds between samples} for every metric at least one connected client displays"""
+        return self._wanted
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        """Counters for every connected client"""
+        return [session.stats() for session in self.sessions()]
+
+clients = ClientRegistry()
+
+def report_client_stats(interval, sampler=None):
+    """Log one summary line per client every interval seconds, instead of a line per send"""
+    previous = {}  # address -> messages sent at the last summary
+    log_dropped = 0
+    while True:
+        time.sleep(interval)
+        if sampler is not None:
+            log.info("Sampler: %s", ', '.join('{} {}'.format(k, v) for k, v in sampler.stats().items()))
+            sampler.reset_stats()
+        current = {}
+        for stat in clients.stats():
+            current[stat['address']] = stat['sent']
+            log.info("Client %s: mode %s, up %ss, sent %d in %.0fs (%d total), dropped %d, suppressed %d, "
+                     "%d bytes, blocked %s, last %s",
+                     stat['address'], stat['mode'], stat['connected'], stat['sent'] - previous.get(stat['address'], 0),
+                     interval, stat['sent'], stat['dropped'], stat['suppressed'], stat['bytes_sent'],
+                     stat['blocked'], stat['last'])
+            if stat['latency']:
+                log.info("Client %s latency: %s", stat['address'], stat['latency'])
+        previous = current
+        dropped = sum(getattr(handler, 'dropped', 0) for handler in log.handlers)
+        if dropped > log_dropped:
+            log.warning("Log queue full, dropped %d lines", dropped - log_dropped)
+            log_dropped = dropped
+
+class IngestServer:
+    """Aggregator side: takes the batches agents push and keeps the newest values per host.
+    Each read applies everything that arrived with one table update, however many frames it held.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def start(self):
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name='ingest')
+        thread.daemon = True
+        thread.start()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port, reuse_address=True)
+        log.info("Aggregating agents on %s:%d", self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        address = "{}:{}".format(*writer.get_extra_info('peername')[:2])
+        name = None
+        try:
+            hello = await reader.readline()
+            words = hello.decode('ascii', 'replace').split()
+            if len(words) != 2 or words[0] != 'AGENT' or not valid_host_name(words[1]):
+                log.warning("Agent %s sent a bad hello: %r", address, hello[:40])
+                return
+            name = words[1].lower()
+            log.info("Agent %s connected from %s", name, address)
+            frames = FrameReader()
+            values = {}
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame_id, value in frames.feed(data):
+                    metric = metric_name(frame_id)
+                    if metric is not None:
+                        values[metric] = value
+                hosts.update(name, dict(values))
+        except Exception as e:
+            log.warning("Agent %s error: %s", name or address, e)
+        finally:
+            writer.close()
+            if name:
+                log.info("Agent %s disconnected", name)
+
+def valid_host_name(name):
+    return name.replace('-', '').replace('_', '').replace('.', '').isalnum() and name.lower() not in AGENT_AGGREGATES
+
+def run_agent(sampler, options):
+    """Agent mode: push this host's metrics to the aggregator every tick, reconnecting with backoff"""
+    metrics = parse_metrics(options.mode)
+    encoder = ClientSession(options.agent, options)
+    encoder.protocol = 'binary'
+    encoder.protocol_version = PROTOCOL_VERSION
+    delay = 0.0
+    while True:
+        if delay:
+            time.sleep(delay)
+        try:
+            sock = socket.create_connection(options.agent, timeout=5.0)
+        except OSError as e:
+            delay = min(AGENT_RETRY_MAX, max(0.5, delay * 2))
+            log.warning("Aggregator %s:%d unavailable (%s), retrying in %.1fs", options.agent[0], options.agent[1], e, delay)
+            continue
+        log.info("Agent %s sending %s to %s:%d", options.name, ','.join(metrics), *options.agent)
+        delay = 0.0
+        try:
+            sock.sendall('AGENT {}\n'.format(options.name).encode())
+            last_seq = 0
+            while True:
+                snapshot = sampler.wait_for_next(last_seq, timeout=sampler.interval * 4)
+                if snapshot is None or snapshot.seq <= last_seq:
+                    continue
+                last_seq = snapshot.seq
+                metric_values = [(metric, snapshot.values[metric]) for metric in metrics if metric in snapshot.values]
+                if metric_values:
+                    sock.sendall(encoder.encode_batch(metric_values, snapshot.timestamp))
+        except OSError as e:
+            log.warning("Aggregator connection lost: %s", e)
+            delay = 0.5
+        finally:
+            sock.close()
+
+class SlowClientError(Exception):
+    """Client socket stayed unwritable past the send deadline"""
+
+def wait_readable(sock, timeout):
+    """True once sock has data to read, False after timeout seconds.
+    poll() where there is one: select() fails for fds of 1024 and up, which the threads engine reaches
+    with many clients (Windows has no poll(), but its select() has no such limit)
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
+def handle_client(client_socket, address, sampler, options):
+    """Handle a connected client (threads engine)"""
+    log.info("Client connected from %s", "{}:{}".format(*address[:2]))
+    session = ClientSession(address, options)
+    clients.add(session)
+    # never block on a slow client, unsent values are dropped by the queue instead
+    client_socket.setblocking(False)
+    try:
+        last_seq = 0
+        while True:
+            # Wait for the shared sampler to publish the next tick. A traced client's socket is watched
+            # until then too, so its acks are read (and timed) as they arrive
+            if session.trace is not None and wait_readable(client_socket, sampler.until_next_tick()):
+                snapshot = sampler.snapshot
+            else:
+                snapshot = sampler.wait_for_next(last_seq, timeout=sampler.interval * 4)
+
+            # Handle anything the client sent (protocol handshake) before encoding the new value
+            try:
+                data = client_socket.recv(1024)
+                if not data:
+                    break  # client closed the connection
+                session.feed(data)
+            except (BlockingIOError, InterruptedError):
+                pass
+
+            if snapshot is not None and snapshot.seq > last_seq:
+                last_seq = snapshot.seq
+                message = session.next_message(snapshot)
+                if message:
+                    session.queue.put(message)
+
             # Send to client
-            client_socket.send("{}\r\n".format(data_to_send).encode())
-            
-            # Wait before next update
-            time.sleep(0.25)
+            if len(session.queue) or session.queue.pending:
+                send_started = time.perf_counter()
+                if session.queue.flush(client_socket):
+                    session.mark_sent()
+                telemetry.observe('send_seconds', time.perf_counter() - send_started, client=session.label)
+            if session.queue.stalled(options.send_deadline):
+                raise SlowClientError("unwritable for more than {}s".format(options.send_deadline))
             
     except Exception as e:
-        print("Client error:", e)
+        log.warning("Client %s error: %s", session.label, e)
+        telemetry.inc('client_errors_total', error=type(e).__name__)
     finally:
+        clients.remove(session)
+        telemetry.forget(client=session.label)
         client_socket.close()
-        print("Client disconnected:", address)
+        log.info("Client %s disconnected (sent %d, dropped %d)", session.label, session.queue.sent, session.queue.dropped)
+        if session.trace is not None:
+            log.info("Client %s latency: %s", session.label, session.trace.summary())
 
-def main():
-    # Server configuration
-    HOST = '192.168.1.201'  # Listen on all interfaces
-    PORT = 9001
-    
-    # Parse command-line arguments
-    mode = 'cpu'  # Default mode
-    if len(sys.argv) > 1:
-        arg = sys.argv[1].lower()
-        if arg in ['cpu', 'ram', 'both']:
-            mode = arg
-            print("Mode: {} usage".format(arg.upper()))
-        else:
-            print("Invalid mode: {}".format(arg))
-            print("Usage: python pc_server.py [cpu|ram|both]")
-            print("  cpu:  CPU usage percentage (suffix 'C')")
-            print("  ram:  RAM usage in GB (with decimal point)")
-            print("  both: Alternates between CPU and RAM every second")
-            return
-    else:
-        print("Mode: CPU usage (default)")
-        print("Usage: python pc_server.py [cpu|ram|both]")
-        print("  cpu:  CPU usage percentage (suffix 'C')")
-        print("  ram:  RAM usage in GB (with decimal point)")
-        print("  both: Alternates between CPU and RAM every second")
-    
+def serve_threads(sampler, options):
+    """Thread-per-client server engine"""
     # Create socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     
     try:
         # Bind to address and port
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(5)  # Allow up to 5 connections
-        print("Server listening on {}:{}".format(HOST, PORT))
-        print("Waiting for connections...")
+        server_socket.bind((options.host, options.port))
+        server_socket.listen(options.backlog)
+        log.info("Server listening on %s:%d", options.host, options.port)
+        log.info("Waiting for connections...")
         
         while True:
             # Accept connection
             client_socket, address = server_socket.accept()
+            telemetry.inc('accepts_total')
             
             # Handle client in a separate thread
             client_thread = threading.Thread(
                 target=handle_client,
-                args=(client_socket, address, mode)
+                args=(client_socket, address, sampler, options)
             )
             client_thread.daemon = True
             client_thread.start()
-            
-    except KeyboardInterrupt:
-        print("\nServer stopping...")
-    except Exception as e:
-        print("Server error:", e)
     finally:
         server_socket.close()
 
+class AsyncServer:
+    """asyncio server engine, all clients are served from one event loop thread.
+    The sampler thread hands each snapshot to the loop, which writes it to every
+    connected client in a single pass - no per-client threads or sleeps.
+    """
+    def __init__(self, sampler, options):
+        self.sampler = sampler
+        self.options = options
+        self.clients = {}  # writer -> ClientSession
+        self.loop = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.sampler.add_listener(self._on_snapshot)
+        server = await asyncio.start_server(
+            self._handle, self.options.host, self.options.port,
+            backlog=self.options.backlog, reuse_address=True
+        )
+        log.info("Server listening on %s:%d (asyncio)", self.options.host, self.options.port)
+        log.info("Waiting for connections...")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.sampler.remove_listener(self._on_snapshot)
+
+    def _on_snapshot(self, snapshot):
+        # called from the sampler thread
+        self.loop.call_soon_threadsafe(self._publish, snapshot)
+
+    def _publish(self, snapshot):
+        now = time.monotonic()
+        for writer, session in list(self.clients.items()):
+            try:
+                queue = session.queue
+                message = session.next_message(snapshot)
+                if message:
+                    queue.put(message)
+                if not len(queue):
+                    continue
+                # only hand data to the transport once it has drained what it already has,
+                # otherwise the queue keeps just the newest values
+                if writer.transport.get_write_buffer_size():
+                    queue.mark_blocked(now)
+                    if queue.stalled(self.options.send_deadline, now):
+                        raise SlowClientError("unwritable for more than {}s".format(self.options.send_deadline))
+                else:
+                    queue.mark_writable()
+                    send_started = time.perf_counter()
+                    writer.write(queue.take())
+                    session.mark_sent()
+                    telemetry.observe('send_seconds', time.perf_counter() - send_started, client=session.label)
+            except Exception as e:
+                log.warning("Client %s error: %s", session.label, e)
+                telemetry.inc('client_errors_total', error=type(e).__name__)
+                self._drop(writer, abort=True)
+
+    def _drop(self, writer, abort=False):
+        session = self.clients.pop(writer, None)
+        if session is not None:
+            clients.remove(session)
+            telemetry.forget(client=session.label)
+            if abort:
+                # don't wait for buffered data to reach a client we've given up on
+                writer.transport.abort()
+            else:
+                writer.close()
+            log.info("Client %s disconnected (sent %d, dropped %d)", session.label, session.queue.sent, session.queue.dropped)
+            if session.trace is not None:
+                log.info("Client %s latency: %s", session.label, session.trace.summary())
+
+    async def _handle(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        telemetry.inc('accepts_total')
+        session = ClientSession(address, self.options)
+        log.info("Client connected from %s", session.label)
+        self.clients[writer] = session
+        clients.add(session)
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                session.feed(data)
+                # send protocol replies straight away rather than on the next tick
+                if not writer.transport.get_write_buffer_size():
+                    writer.write(session.queue.take())
+                    session.mark_sent()
+        except Exception as e:
+            log.warning("Client %s error: %s", session.label, e)
+            telemetry.inc('client_errors_total', error=type(e).__name__)
+        finally:
+            self._drop(writer)
+
+def serve_asyncio(sampler, options):
+    """asyncio server engine"""
+    asyncio.run(AsyncServer(sampler, options).serve())
+
+class UdpPublisher:
+    """Sends each snapshot as one datagram to a multicast group or broadcast address.
+    Encoding is done once per snapshot by a single binary v2 session, so the cost doesn't
+    grow with the number of displays listening. Registered with the client registry so
+    the sampler collects its metrics and it shows up in the stats.
+    """
+    def __init__(self, sampler, target, options):
+        self.sampler = sampler
+        self.target = target
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, options.udp_ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)  # displays on this machine hear it too
+        if options.udp_interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(options.udp_interface))
+        self.sock.setblocking(False)
+        self.session = ClientSession(target, options)
+        self.session.protocol = 'binary'
+        self.session.protocol_version = PROTOCOL_VERSION
+
+    def start(self):
+        clients.add(self.session)
+        self.sampler.add_listener(self._on_snapshot)
+        log.info("Publishing to udp://%s:%d", *self.target)
+
+    def stop(self):
+        self.sampler.remove_listener(self._on_snapshot)
+        clients.remove(self.session)
+        self.sock.close()
+
+    def _on_snapshot(self, snapshot):
+        # called from the sampler thread
+        message = self.session.next_message(snapshot)
+        if not message:
+            return
+        queue = self.session.queue
+        send_started = time.perf_counter()
+        try:
+            self.sock.sendto(message, self.target)
+            queue.sent += 1
+            queue.bytes_sent += len(message)
+        except OSError as e:
+            # full socket buffer or no route, the next snapshot replaces this one anyway
+            queue.dropped += 1
+            telemetry.inc('client_errors_total', error=type(e).__name__)
+        telemetry.observe('send_seconds', time.perf_counter() - send_started, client=self.session.label)
+
+def telemetry_gauges():
+    """Values read at scrape time instead of being tracked on the hot path"""
+    client_stats = clients.stats()
+    return [
+        ('agent_age_seconds', "Seconds since each agent last pushed values",
+         [((('host', host),), age) for host, age in hosts.stats().items()]),
+        ('clients_connected', "Connected clients", [((), len(client_stats))]),
+        ('client_bytes_sent', "Bytes sent to each client",
+         [((('client', c['address']),), c['bytes_sent']) for c in client_stats]),
+        ('client_messages_sent', "Messages sent to each client",
+         [((('client', c['address']),), c['sent']) for c in client_stats]),
+        ('client_messages_dropped', "Messages dropped by each client's latest-value-wins queue",
+         [((('client', c['address']),), c['dropped']) for c in client_stats]),
+        ('collector_cost_seconds', "Smoothed sample time per collector",
+         [((('collector', c.name),), round(c.cost, 6)) for c in COLLECTORS.values() if c.samples]),
+    ]
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics in the Prometheus text format"""
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = telemetry.render(telemetry_gauges()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the console
+
+def start_metrics_server(host, port):
+    """Enable telemetry and serve it over HTTP from a background thread"""
+    telemetry.enabled = True
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    metrics_thread = threading.Thread(target=httpd.serve_forever, name='metrics')
+    metrics_thread.daemon = True
+    metrics_thread.start()
+    log.info("Metrics on http://%s:%d/metrics", host, port)
+    return httpd
+
+ENGINES = {
+    'threads': serve_threads,
+    'asyncio': serve_asyncio,
+}
+
+def parse_address(text, default_port=UDP_PORT):
+    """argparse type for HOST:PORT, the port defaults to UDP_PORT"""
+    host, _, port = text.rpartition(':')
+    if not host:
+        host, port = text, default_port
+    try:
+        socket.inet_aton(host)
+        return host, int(port)
+    except (OSError, ValueError):
+        raise argparse.ArgumentTypeError("expected IPV4ADDRESS[:PORT], got '{}'".format(text))
+
+def parse_heartbeat(text):
+    """argparse type for --heartbeat, above 0 and at most MAX_SILENCE seconds"""
+    try:
+        seconds = float(text)
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= MAX_SILENCE:
+        raise argparse.ArgumentTypeError("expected seconds above 0 and at most {}, got '{}'".format(MAX_SILENCE, text))
+    return seconds
+
+def check_metric_key(name, collectors_only=False):
+    """Reject an option key that would never match: a collector name (all its metrics, e.g. core or net)
+    or, unless collectors_only, one metric (core0, net_rx, cpu@web1)
+    """
+    if name in COLLECTORS:
+        return name
+    if collectors_only:
+        raise argparse.ArgumentTypeError("unknown collector '{}', expected one of {}".format(name, ', '.join(COLLECTORS)))
+    if find_collector(name) is None:
+        raise argparse.ArgumentTypeError("unknown metric or collector '{}'".format(name))
+    return name
+
+def parse_number_map(text, collectors_only=False):
+    """Parse 'cpu=1,net_rx=0.1' into a dict of collector or metric name -> number"""
+    values = {}
+    try:
+        for item in text.split(','):
+            if item.strip():
+                name, value = item.split('=')
+                values[name.strip().lower()] = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected NAME=N[,NAME=N...], got '{}'".format(text))
+    for name in values:
+        check_metric_key(name, collectors_only)
+    return values
+
+def parse_metric_map(text):
+    """--deadband: per collector (every metric it provides) or per metric, a metric beats its collector"""
+    return parse_number_map(text)
+
+def parse_collector_map(text):
+    """--interval: collectors sample all their metrics at once, so intervals are per collector"""
+    return parse_number_map(text, collectors_only=True)
+
+def parse_filters(text):
+    """Parse 'cpu=median:5+ema:0.3,load1=rate' into a dict of collector or metric name -> FilterChain spec"""
+    chains = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        try:
+            name, spec = item.split('=')
+            stages = []
+            for stage in spec.split('+'):
+                kind, _, arg = stage.strip().lower().partition(':')
+                if kind not in FILTER_STAGES:
+                    raise argparse.ArgumentTypeError("unknown filter stage '{}', expected one of {}".format(
+                        kind, ', '.join(FILTER_STAGES)))
+                if arg and kind == 'rate':
+                    raise ValueError("rate takes no argument")
+                stages.append((FILTER_STAGES[kind], (float(arg),) if arg else ()))
+            FilterChain(stages)  # bad arguments raise here rather than on the first sample
+        except ValueError as e:
+            raise argparse.ArgumentTypeError("expected NAME=STAGE[:N][+STAGE...], got '{}' ({})".format(item, e))
+        chains[check_metric_key(name.strip().lower())] = stages
+    return chains
+
+def mode_arg(text):
+    """argparse type for the mode, checks the metric names but keeps the text"""
+    parse_metrics(text)
+    return text.lower()
+
+def build_parser():
+    """Command-line options for the server"""
+    parser = argparse.ArgumentParser(
+        description="Serve CPU/RAM usage to the PICO 8-segment display client",
+        epilog="cpu:  CPU usage percentage (suffix 'C')\n"
+               "ram:  RAM usage in GB (with decimal point)\n"
+               "both: Alternates between CPU and RAM every second\n"
+               "or any comma separated list of metrics, which take turns every second:\n"
+               "  swap, load1/load5/load15, core0..coreN, net_rx/net_tx (MB/s, suffix 'B'),\n"
+               "  disk_read/disk_write (MB/s, suffix 'D'), temp/temp0..tempN (suffix 'E')",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('mode', nargs='?', default='cpu', type=mode_arg,
+                        help="what to serve: cpu, ram, both or METRIC[,METRIC...] (default cpu)")
+    parser.add_argument('--backend', default='auto', choices=['auto'] + list(BACKENDS),
+                        help="metric backend, auto uses psutil if installed else /proc")
+    parser.add_argument('--host', default=HOST, help="address to listen on (default {})".format(HOST))
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on (default {})".format(PORT))
+    parser.add_argument('--engine', default='threads', choices=list(ENGINES),
+                        help="threads: one thread per client, asyncio: single event loop for all clients")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help="listen() backlog for pending connections (default {})".format(LISTEN_BACKLOG))
+    parser.add_argument('--queue-size', type=int, default=SEND_QUEUE_SIZE,
+                        help="messages queued per client before the oldest is dropped (default {})".format(SEND_QUEUE_SIZE))
+    parser.add_argument('--send-deadline', type=float, default=SEND_DEADLINE,
+                        help="seconds a client may stay unwritable before it is disconnected (default {})".format(SEND_DEADLINE))
+    parser.add_argument('--push', default='always', choices=PUSH_MODES,
+                        help="always: send every tick, change: only send values that moved past the deadband")
+    parser.add_argument('--deadband', type=parse_metric_map, default={}, metavar='COLLECTOR|METRIC=N[,...]',
+                        help="change push deadbands per collector or metric, overriding the collector defaults ({})".format(
+                            ','.join('{}={}'.format(c.name, c.deadband) for c in COLLECTORS.values())))
+    parser.add_argument('--filter', type=parse_filters, default={}, metavar='COLLECTOR|METRIC=STAGE[:N][+STAGE...][,...]',
+                        help="smooth a metric, or every metric of a collector, on the server before it is sent, "
+                             "stages run in order: "
+                             "ema:ALPHA, median:SAMPLES, peak:HOLD_SECONDS, rate (change per second), "
+                             "e.g. cpu=median:5+ema:0.3")
+    parser.add_argument('--interval', type=parse_collector_map, default={}, metavar='COLLECTOR=SECONDS[,...]',
+                        help="sampling interval per collector ({})".format(
+                            ','.join('{}={}'.format(c.name, c.interval) for c in COLLECTORS.values())))
+    parser.add_argument('--heartbeat', type=parse_heartbeat, default=HEARTBEAT_INTERVAL,
+                        help="change push resends the value after this many idle seconds, "
+                             "at most {} (default {})".format(MAX_SILENCE, HEARTBEAT_INTERVAL))
+    parser.add_argument('--agent', type=lambda text: parse_address(text, AGGREGATE_PORT), metavar='ADDRESS[:PORT]',
+                        help="agent mode: push the mode's metrics to this aggregator instead of serving displays")
+    parser.add_argument('--name', default=socket.gethostname().split('.')[0].lower(),
+                        help="host name this agent reports as (default: hostname)")
+    parser.add_argument('--aggregate-port', type=int, default=0,
+                        help="take pushes from agents on this port, displays can then show METRIC@HOST "
+                             "or METRIC@{} (default off, usually {})".format('|'.join(AGENT_AGGREGATES), AGGREGATE_PORT))
+    parser.add_argument('--history', type=parse_metrics, default=[], metavar='METRIC[,METRIC...]',
+                        help="always sample these for the history, even with no display showing them "
+                             "(otherwise only metrics being displayed are recorded)")
+    parser.add_argument('--udp', type=parse_address, metavar='ADDRESS[:PORT]',
+                        help="also publish every snapshot to this multicast group or broadcast address "
+                             "(e.g. 239.1.2.3, port defaults to {})".format(UDP_PORT))
+    parser.add_argument('--udp-ttl', type=int, default=UDP_TTL,
+                        help="multicast TTL (default {})".format(UDP_TTL))
+    parser.add_argument('--udp-interface', metavar='ADDRESS',
+                        help="local address of the interface to send multicast from (default: routing table)")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics on this port (default off)")
+    parser.add_argument('--metrics-host', default=METRICS_HOST,
+                        help="address for the metrics endpoint (default {})".format(METRICS_HOST))
+    parser.add_argument('--stats-interval', type=float, default=LOG_SUMMARY_INTERVAL,
+                        help="log a per-client send/drop summary every N seconds, 0 = off (default {})".format(LOG_SUMMARY_INTERVAL))
+    parser.add_argument('--log-level', default='info', choices=LOG_LEVELS,
+                        help="debug also logs every value sent to every client (default info)")
+    parser.add_argument('--log-queue', type=int, default=LOG_QUEUE_SIZE,
+                        help="log lines buffered for the writer thread before new ones are dropped (default {})".format(LOG_QUEUE_SIZE))
+    return parser
+
+def main():
+    # Parse command-line arguments
+    args = build_parser().parse_args()
+    log_listener = setup_logging(args.log_level, args.log_queue)
+    try:
+        run(args)
+    finally:
+        log_listener.stop()  # writes out whatever is still queued
+
+def run(args):
+    mode = args.mode
+    log.info("Mode: %s usage", mode.upper())
+
+    try:
+        backend = select_backend(args.backend)
+    except (ImportError, OSError) as e:
+        log.error("Metric backend '%s' unavailable: %s", args.backend, e)
+        return
+    log.info("Metric backend: %s", backend.name)
+
+    for name, interval in args.interval.items():
+        COLLECTORS[name].interval = interval
+    for name, spec in args.filter.items():
+        (COLLECTORS.get(name) or find_collector(name)).filter_specs[name] = spec
+
+    if args.metrics_port:
+        try:
+            start_metrics_server(args.metrics_host, args.metrics_port)
+        except OSError as e:
+            log.error("Metrics endpoint unavailable: %s", e)
+            return
+
+    # Start the shared sampler, all clients read its snapshots
+    # only the collectors some connected client needs are run
+    # metrics asked for with --history are collected even with no display showing them
+    keep = frozenset(args.history)
+    if args.agent:
+        if not valid_host_name(args.name):
+            log.error("Agent name '%s' must be letters, digits, '-', '_' or '.', and not %s",
+                      args.name, '/'.join(AGENT_AGGREGATES))
+            return
+        keep = frozenset(parse_metrics(args.mode))
+
+    if args.agent or args.udp:
+        # both only speak binary frames
+        try:
+            check_binary_metrics(parse_metrics(args.mode))
+        except argparse.ArgumentTypeError as e:
+            log.error("%s, --agent and --udp can't send it", e)
+            return
+
+    def demand():
+        wanted = dict.fromkeys(keep)
+        wanted.update(clients.wanted_metrics())
+        return wanted
+
+    sampler = Sampler(demand=demand)
+    sampler.add_listener(history.record)
+    sampler.start()
+
+    if args.agent:
+        try:
+            run_agent(sampler, args)
+        except KeyboardInterrupt:
+            log.info("Agent stopping...")
+        return
+
+    if args.aggregate_port:
+        IngestServer(args.host, args.aggregate_port).start()
+
+    if args.udp:
+        try:
+            UdpPublisher(sampler, args.udp, args).start()
+        except OSError as e:
+            log.error("UDP publish unavailable: %s", e)
+            return
+
+    if args.stats_interval > 0:
+        stats_thread = threading.Thread(target=report_client_stats, args=(args.stats_interval, sampler), name='client-stats')
+        stats_thread.daemon = True
+        stats_thread.start()
+
+    try:
+        ENGINES[args.engine](sampler, args)
+    except KeyboardInterrupt:
+        log.info("Server stopping...")
+    except Exception as e:
+        log.error("Server error: %s", e)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
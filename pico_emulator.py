@@ -0,0 +1,498 @@
+# pico_emulator.py
+# runs the real main.py client loop under CPython on a desktop, against a local pc_server.py.
+# fake network, machine (Pin/SPI), _thread and wifi_settings modules are installed before main.py is imported,
+# every SPI write and latch toggle is recorded and decoded back into what the display would show.
+# the client talks to the server through a local relay that timestamps bytes as they arrive, so latency
+# includes the time data waits in the client's socket as well as parsing and display refresh.
+# reports end-to-end update latency, effective refresh rate, dropped updates and the decoded display contents,
+# so client performance regressions show up before flashing a fleet of boards.
+#
+# python3 pico_emulator.py both --duration 10
+# python3 pico_emulator.py --server 127.0.0.1:9001 --protocol binary --json
+# python3 pico_emulator.py both --udp 239.1.2.3:9102   (server publishes over udp, client subscribes)
+#
+import argparse
+import json
+import os
+import socket
+import _thread
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+#AUTO-V
+version = "v0.1-2025/12/07r00"
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Digit address codes, must match main.py
+DIGIT_ADDRS = (0xFE, 0xFD, 0xFB, 0xF7)
+
+
+class Recorder:
+    """Collects everything the fake hardware and the relay see, with timestamps"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.start_wall = time.time()
+        self.spi_writes = 0
+        self.latches = 0
+        self.unit_writes = 0  # non-blank writes to the last digit = completed refresh frames
+        self.segments = dict((addr, 0) for addr in DIGIT_ADDRS)
+        self.frames = []  # (time, 4 segment bytes) every time the shown content changes
+        self.received = []  # (time, bytes) sent by the server to the client
+
+    def reset_clock(self):
+        self.start = time.monotonic()
+        self.start_wall = time.time()
+
+    def now(self):
+        return time.monotonic() - self.start
+
+    def latch(self, data):
+        """A latch rising edge with the last SPI data: one digit was updated"""
+        with self.lock:
+            self.latches += 1
+            if len(data) != 2 or data[0] not in self.segments:
+                return
+            addr, seg = data[0], data[1]
+            if seg == 0:
+                return  # brightness blanking or clear, not content
+            self.segments[addr] = seg
+            if addr == DIGIT_ADDRS[-1]:
+                # last digit written, one whole frame is on the display
+                self.unit_writes += 1
+                content = bytes(self.segments[a] for a in DIGIT_ADDRS)
+                if not self.frames or self.frames[-1][1] != content:
+                    self.frames.append((self.now(), content))
+
+    def recv(self, data):
+        with self.lock:
+            self.received.append((self.now(), data))
+
+
+recorder = Recorder()
+
+
+# ---- fake MicroPython modules ----
+
+class FakePin:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, pin, mode=None, *args, **kwargs):
+        self.pin = pin
+        self.state = 0
+        self.spi = None  # set for the latch pin so a rising edge can be matched with the SPI data
+
+    def value(self, v=None):
+        if v is None:
+            return self.state
+        if v and not self.state and self.spi is not None:
+            recorder.latch(self.spi.last)
+        self.state = 1 if v else 0
+
+
+class FakeSPI:
+    def __init__(self, *args, **kwargs):
+        self.last = b''
+
+    def write(self, data):
+        recorder.spi_writes += 1
+        self.last = bytes(data)
+
+
+class FakeWLAN:
+    def __init__(self, *args):
+        pass
+
+    def active(self, *args):
+        return True
+
+    def connect(self, *args):
+        pass
+
+    def isconnected(self):
+        return True
+
+    def status(self):
+        return 3
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+
+class Relay:
+    """Forwards client connections to the real server, timestamping every chunk from the server"""
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        t = threading.Thread(target=self._accept, name='relay')
+        t.daemon = True
+        t.start()
+
+    def _accept(self):
+        while True:
+            client, address = self.listener.accept()
+            try:
+                server = socket.create_connection(self.upstream)
+            except OSError:
+                client.close()
+                continue
+            for src, dst, record in ((server, client, True), (client, server, False)):
+                t = threading.Thread(target=self._pipe, args=(src, dst, record))
+                t.daemon = True
+                t.start()
+
+    def _pipe(self, src, dst, record):
+        try:
+            while True:
+                data = src.recv(4096)
+                if not data:
+                    break
+                if record:
+                    recorder.recv(data)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            src.close()
+            dst.close()
+
+
+def install_fakes():
+    """Put the fake hardware modules in sys.modules so main.py can be imported"""
+    machine = types.ModuleType('machine')
+    machine.Pin = FakePin
+    machine.SPI = FakeSPI
+    network = types.ModuleType('network')
+    network.WLAN = FakeWLAN
+    network.STA_IF = 0
+    # the real _thread underneath (threading and asyncio need it), with daemon threads for the client
+    thread = types.ModuleType('_thread')
+    thread.__dict__.update((k, v) for k, v in vars(_thread).items() if not k.startswith('__'))
+
+    def start_new_thread(func, args):
+        t = threading.Thread(target=func, args=args)
+        t.daemon = True
+        t.start()
+    thread.start_new_thread = start_new_thread
+    wifi_settings = types.ModuleType('wifi_settings')
+    wifi_settings.WIFI_SSID = 'emulator'
+    wifi_settings.WIFI_PASSWORD = ''
+    for name, module in [('machine', machine), ('network', network), ('_thread', thread), ('wifi_settings', wifi_settings)]:
+        sys.modules[name] = module
+
+
+def load_client(host, port, protocol, test_loop=False):
+    """Import main.py with the fakes in place and point it at host:port"""
+    install_fakes()
+    sys.path.insert(0, HERE)
+    import main as client
+    client.PC_IP = host
+    client.PC_PORT = port
+    client.PROTOCOL = protocol
+    if not test_loop:
+        client.test_loop = lambda display: None
+
+    # hook the latch pin up to the SPI bus it latches
+    original_init = client.LED_8SEG.__init__
+
+    def init(self):
+        original_init(self)
+        self.rclk.spi = self.spi
+    client.LED_8SEG.__init__ = init
+    return client
+
+
+# ---- analysis ----
+
+def decode_segments(client, content):
+    """Turn 4 segment bytes back into display text, e.g. '045C', '01.2' or '-05C'"""
+    lookup = dict((code, '0123456789ABCDEF-'[i]) for i, code in enumerate(client.SEG8Code))
+    text = ''
+    for seg in content:
+        text += lookup.get(seg & 0x7F, '?')
+        if seg & client.Dot:
+            text += '.'
+    return text
+
+
+def listen_udp(client, address):
+    """Switch the client to its udp subscriber, recording datagrams as they are received"""
+    group, port = address.rsplit(':', 1)
+    client.TRANSPORT = 'udp'
+    client.UDP_GROUP = group
+    client.UDP_PORT = int(port)
+    original_recv = client.DatagramReader.recv
+
+    async def recv(self, size):
+        data = await original_recv(self, size)
+        recorder.recv(data)
+        return data
+    client.DatagramReader.recv = recv
+
+
+def parse_received(client, protocol):
+    """Replay the received bytes through the client's own parsing, return [(time, value, suffix, sample_ms)]
+    with segments the value is the 4 segment bytes the server rendered
+    """
+    values = []
+    decoder = client.FrameDecoder()
+    segment_reader = client.SegmentReader()
+    text_buffer = b''
+    for t, data in recorder.received:
+        if protocol == 'segments':
+            # a byte at a time, so every frame comes out and not just the newest one the client shows
+            for i in range(len(data)):
+                segments = segment_reader.latest(data[i:i + 1])
+                if segments is not None:
+                    values.append((t, bytes(segments), frame_suffix(client, segments), None))
+        elif protocol == 'binary':
+            for metric_id, value, seq, timestamp in decoder.feed(data):
+                if metric_id == client.METRIC_BATCH:
+                    for entry_id, entry_value in value:
+                        values.append((t, entry_value, client.METRIC_SUFFIX.get(entry_id, ''), timestamp))
+                elif metric_id in client.METRIC_SUFFIX:
+                    values.append((t, value, client.METRIC_SUFFIX[metric_id], timestamp))
+        else:
+            text_buffer += data
+            while b'\n' in text_buffer:
+                line, text_buffer = text_buffer.split(b'\n', 1)
+                line = line.strip().decode()
+                if not line:
+                    continue
+                line = line.split()[0]  # traced lines end in "<seq> <sample ms>"
+                suffix = ''
+                if line[-1].isalpha():
+                    suffix = line[-1].upper()
+                    line = line[:-1]
+                try:
+                    values.append((t, float(line), suffix, None))
+                except ValueError:
+                    pass
+    return values
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def frame_suffix(client, content):
+    """Suffix letter shown on the last digit of a frame, '' for plain numbers"""
+    last = content[-1] & 0x7F
+    for letter in 'ABCDEF':
+        if client.SEG8Code[10 + 'ABCDEF'.index(letter)] == last:
+            return letter
+    return ''
+
+
+def analyse(client, protocol, duration):
+    """Match received values with display changes.
+    A value counts as dropped only if the display was showing its kind of metric (same suffix)
+    before the next value of that kind arrived, but never showed this value - values skipped
+    because the display was rotated to another metric are counted as not shown.
+    """
+    received = parse_received(client, protocol)
+    frames = list(recorder.frames)
+    latencies = []
+    sample_latencies = []
+    dropped = 0
+    not_shown = 0
+    unchanged = 0
+    for i, (t, value, suffix, sample_ms) in enumerate(received):
+        if protocol == 'segments':
+            expected = value
+        else:
+            expected = bytearray(4)
+            client.render_segments(value, suffix, expected)
+            expected = bytes(expected)
+        window_end = None
+        for later in received[i + 1:]:
+            if later[2] == suffix:
+                window_end = later[0]
+                break
+        # what was on the display when it arrived
+        before = [content for frame_t, content in frames if frame_t < t]
+        if before and before[-1] == expected:
+            unchanged += 1
+            continue
+        match = None
+        same_kind = False
+        for frame_t, content in frames:
+            if frame_t < t:
+                continue
+            if window_end is not None and frame_t > window_end:
+                break
+            if content == expected:
+                match = frame_t
+                break
+            if frame_suffix(client, content) == suffix:
+                same_kind = True
+        if match is not None:
+            latencies.append((match - t) * 1000.0)
+            if sample_ms is not None:
+                shown_ms = int((recorder.start_wall + match) * 1000) & 0xFFFFFFFF
+                sample_latencies.append(((shown_ms - sample_ms) & 0xFFFFFFFF) * 1.0)
+        elif same_kind:
+            dropped += 1
+        else:
+            not_shown += 1
+
+    def summary(values):
+        if not values:
+            return {'min': None, 'p50': None, 'p95': None, 'max': None}
+        return {
+            'min': round(min(values), 2),
+            'p50': round(percentile(values, 50), 2),
+            'p95': round(percentile(values, 95), 2),
+            'max': round(max(values), 2),
+        }
+
+    return {
+        'protocol': protocol,
+        'duration_s': round(duration, 2),
+        'bytes_received': sum(len(d) for t, d in recorder.received),
+        'values_received': len(received),
+        'display_updates': len(frames),
+        'values_shown': len(latencies),
+        'values_unchanged': unchanged,
+        'values_not_shown': not_shown,
+        'dropped_updates': dropped,
+        'latency_ms': summary(latencies),  # arrival at the client socket -> on the display
+        'sample_latency_ms': summary(sample_latencies),  # server sample time -> on the display (binary only)
+        'refresh_hz': round(recorder.unit_writes / duration, 1) if duration else 0,
+        'spi_writes': recorder.spi_writes,
+        'latch_toggles': recorder.latches,
+        'refresh_stats': client.refresh.stats(),
+        'display': [decode_segments(client, content) for t, content in frames[-10:]],
+    }
+
+
+def start_server(mode, port, extra_args, log_file=None):
+    """Start pc_server.py on loopback, return the process. Its log goes to log_file if given"""
+    cmd = [sys.executable, os.path.join(HERE, 'pc_server.py'), mode, '--host', '127.0.0.1', '--port', str(port)]
+    cmd += extra_args
+    output = log_file or subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, stdout=output, stderr=output)
+    # wait for it to listen
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("pc_server.py did not start listening on port {}".format(port))
+
+
+def server_latency(log_file):
+    """The newest per-stage latency summary a traced server logged, or None"""
+    log_file.seek(0)
+    latest = None
+    for line in log_file.read().decode('utf-8', 'replace').splitlines():
+        if ' latency: ' in line:
+            latest = line.split(' latency: ', 1)[1]
+    return latest
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run main.py under CPython against a local pc_server.py")
+    parser.add_argument('mode', nargs='?', default='both', help="server mode when starting a local server (default both)")
+    parser.add_argument('--server', help="HOST:PORT of an already running server, otherwise one is started")
+    parser.add_argument('--server-args', default='', help="extra arguments for the started pc_server.py")
+    parser.add_argument('--protocol', default='text', choices=['text', 'binary', 'segments'],
+                        help="client wire protocol")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run (default 10)")
+    parser.add_argument('--subscribe', default='', metavar='"METRICS [HZ]"',
+                        help="client subscribes to its own metrics and rate, e.g. \"ram 1\"")
+    parser.add_argument('--udp', metavar='GROUP:PORT',
+                        help="client subscribes to udp frames at GROUP:PORT, a started server publishes there")
+    parser.add_argument('--trace', action='store_true',
+                        help="client asks for latency tracing and acks, a started server's results are in the report")
+    parser.add_argument('--test-loop', action='store_true', help="run the client's start-up count test too")
+    parser.add_argument('--quiet', action='store_true', help="hide the client's own print output")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    server = None
+    server_log = None
+    server_args = args.server_args.split()
+    if args.trace and not args.server:
+        # summaries every second so the report gets the server's latency stats, --server-args can override it
+        server_args = ['--stats-interval', '1'] + server_args
+        server_log = tempfile.TemporaryFile()
+    if args.udp:
+        args.protocol = 'binary'  # udp frames are always binary
+        server_args += ['--udp', args.udp]
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', free_port()
+        server = start_server(args.mode, port, server_args, server_log)
+
+    relay = Relay((host, port))
+    client = load_client('127.0.0.1', relay.port, args.protocol, args.test_loop)
+    client.SUBSCRIBE = args.subscribe
+    client.TRACE = args.trace
+    if args.udp:
+        listen_udp(client, args.udp)
+    if args.quiet or args.json:
+        client.print = lambda *a, **k: None
+
+    try:
+        runner = threading.Thread(target=client.main, name='client')
+        runner.daemon = True
+        recorder.reset_clock()
+        runner.start()
+        time.sleep(args.duration)
+        report = analyse(client, args.protocol, recorder.now())
+        if args.trace:
+            report['server_latency'] = server_latency(server_log) if server_log else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if server_log is not None:
+            server_log.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("Emulated {} client for {}s".format(report['protocol'], report['duration_s']))
+        print("  received:  {} values, {} bytes".format(report['values_received'], report['bytes_received']))
+        print("  display:   {} updates, {} values shown, {} unchanged, {} rotated away, {} dropped".format(
+            report['display_updates'], report['values_shown'], report['values_unchanged'],
+            report['values_not_shown'], report['dropped_updates']))
+        print("  latency:   {}".format(', '.join('{} {}ms'.format(k, v) for k, v in report['latency_ms'].items())))
+        if args.protocol == 'binary':
+            print("  from sample: {}".format(', '.join('{} {}ms'.format(k, v) for k, v in report['sample_latency_ms'].items())))
+        print("  refresh:   {} Hz measured, scheduler {}".format(report['refresh_hz'], report['refresh_stats']))
+        print("  SPI:       {} writes, {} latch toggles".format(report['spi_writes'], report['latch_toggles']))
+        print("  last shown: {}".format(' '.join(report['display'])))
+        if args.trace:
+            print("  server:    {}".format(report['server_latency'] or "no latency logged yet (with --server see its log)"))
+
+
+if __name__ == "__main__":
+    main()